@@ -1,19 +1,31 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import networkx as nx
+import h2o
+import hbnet
+import spectra
 
-Afile='trash.dat'
-A = np.loadtxt(Afile)
-A = A.astype(int)
 
-G=nx.from_numpy_matrix(A)
+# H-bond network of the first frame, as sparse
+# donor --> acceptor edges
+ANIfile="./water_1step.ANI"
+napm=3
+OOcutoff=4.5 # Ang
 
-plt.matshow(A)
-#plt.show()
+l=14.7222 # (Ang)
+A=np.vstack(([l,0,0],[0,l,0],[0,0,l])).T # Transpose is crucial!!
+
+nat, comment, element, x = h2o.getframe(ANIfile, 0)
+snap=h2o.snapshot(nat, A, x, element=element)
+allmol=h2o.cluster.from_snapshot(snap, napm)
+allmol.FindH2Os(snap.A, snap.Ainv, cutoff=OOcutoff)
+
+donor, acceptor, hdon, rOO, theta = h2o.find_hbonds(allmol, rcut=3.5, thetacut=30.0)
+G=hbnet.graph(allmol.nmol, donor, acceptor)
+S=hbnet.stats(G)
 
-NCC=nx.number_connected_components(G)
-print "# of connected components =", NCC
-nx.draw(G, with_labels=True)
+
+print "# of connected components =", S['ncomp']
+print "# of strongly connected components =", S['nscomp']
 
 
 # Prepare subplots
@@ -24,32 +36,36 @@ axL=fig.add_subplot(223)
 axC=fig.add_subplot(224)
 
 
-edges=np.arange(0,max(nx.degree(G).values())+2)
-axD.hist(sorted(nx.degree(G).values()), edges)
+edges=np.arange(0,len(S['degdist'])+1)
+axD.bar(edges[:-1], S['degdist'], width=1.0)
 axD.set_xlabel('Node degree')
 axD.set_ylabel('Frequency')
 axD.title.set_text('Node degree distribution of A')
 
 
-A=nx.to_numpy_matrix(G)
-axA.plot(np.sort(np.linalg.eigvals( A ) ) )
-axA.set_xlim(0,np.shape(A)[0])
+# Extreme eigenvalues of the undirected network: nev
+# largest of A and nev smallest of L_n, from sparse 
+# matrices
+nev=20
+U=hbnet.undirected(G)
+wA=spectra.spectrum(nev, matrix='A', which='LA')(G)
+axA.plot(np.arange(U.n-len(wA), U.n), wA)
+axA.set_xlim(0,U.n)
 axA.set_xlabel('eigenvector index')
 axA.set_ylabel('eigenvalue')
 axA.title.set_text('Eigenvalue spectrum of A')
 
 
-L=nx.normalized_laplacian_matrix(G)
-axL.plot(np.sort(np.linalg.eigvals( L.todense() ) ) )
-axL.set_xlim(0,np.shape(L)[0])
+wL=spectra.spectrum(nev, matrix='L', which='SA')(G)
+axL.plot(np.arange(len(wL)), wL)
+axL.set_xlim(0,U.n)
 axL.set_xlabel('eigenvector')
 axL.set_ylabel('eigenvalue')
 axL.title.set_text('Eigenvalue spectrum of L_n')
     #plt.show()
 
-C=nx.degree_centrality(G)
-axC.plot(np.sort(C.values()) )
-axC.set_xlim(0,np.shape(L)[0])
+axC.plot(np.sort(S['centrality']) )
+axC.set_xlim(0,U.n)
 axC.set_xlabel('node index')
 axC.set_ylabel('centrality')
 axC.title.set_text('Degree centrality spectrum')
@@ -59,23 +75,12 @@ plt.tight_layout()
 
 
 
-A1 =A.astype(int)
-A2 =np.dot(A1 , A1)
-A3 =np.dot(A2 , A1)
-A4 =np.dot(A3 , A1)
-A5 =np.dot(A4 , A1)
-A6 =np.dot(A5 , A1)
-A7 =np.dot(A6 , A1)
-A8 =np.dot(A7 , A1)
-A9 =np.dot(A8 , A1)
-A10=np.dot(A9 , A1)
+# Closed walks of length 1..10 of each molecule on the
+# undirected network
+W=hbnet.closedwalks(U, 10)
 
-Nmol=A.shape
-Nmol=Nmol[0]
+Nmol=U.n
 
 print Nmol
 for i in range(0, Nmol):
-    print i, A1[i,i], A2[i,i], A3[i,i], A4[i,i], A5[i,i], A6[i,i], A7[i,i], A8[i,i], A9[i,i], A10[i,i]
-    
-
-
+    print i, " ".join([str(w) for w in W[i]])
@@ -0,0 +1,67 @@
+#
+# Example to calculate H-bond time correlation functions
+# C(t) (intermittent) and S(t) (continuous).
+# 
+#
+import numpy as np
+import h2o
+import hbcorr
+
+
+
+######################################################################
+##############       PROGRAM    STARTS    HERE        ################
+######################################################################
+
+
+
+# Input data file
+ANIfile="./water_100steps.ANI"
+
+#number of atoms per molecule
+napm=3 
+
+
+# OO cutoff for H2O identification
+OOcutoff = 4.5  # Ang
+
+# Largest time lag (frames)
+tmax=50
+
+
+# Simulation cell vectors and transformation matrix
+ct="cartesian"
+l=14.7222 # (Ang)
+a1=[l,0,0]
+a2=[0,l,0]
+a3=[0,0,l]
+A=np.vstack((a1,a2,a3)).T # Transpose is crucial!!
+
+
+# Molecules are found in the first frame and only
+# checked for proton transfers in the following ones
+topo=None
+hist=None
+
+
+# Loop over all shapshots in file, storing the H-bond
+# history of every donor-acceptor pair
+for nat, comment, element, x in h2o.prefetch(h2o.iter_frames(ANIfile)):
+    
+    snap=h2o.snapshot(nat, A, x, coordtype=ct, element=element)
+    allmol=h2o.cluster.from_snapshot(snap, napm)
+    if topo is None:
+        topo=h2o.topology(allmol, cutoff=OOcutoff)
+        hist=hbcorr.hbhistory(allmol.nmol)
+    else:
+        topo.update(allmol)
+
+    donor, acceptor, hdon, rOO, theta = h2o.find_hbonds(allmol, rcut=3.5, thetacut=30.0)
+    hist.add(donor, acceptor)
+
+
+C, S = hist.correlations(tmax=tmax)
+
+print "# t(frames)   C(t)   S(t)"
+for t in range(0, len(C)):
+    print t, C[t], S[t]
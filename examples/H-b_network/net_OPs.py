@@ -8,6 +8,7 @@
 import math
 import numpy as np
 import h2o
+import hbnet
 
 
 
@@ -28,14 +29,11 @@ napm=3
 # OO cutoff for H2O identification
 OOcutoff = 4.5  # Ang
 
-# Read file
-nat=[]
-comments=[]
-txyz=[] # list of lists containing [atomtype, x,y,z]
-nat, comments, txyz = h2o.readANI(ANIfile)
-
-
-nsnap=len(nat)
+# Frames are read one at a time from the file inside
+# the loop below, so memory use does not grow with the
+# length of the trajectory. The next frames are read in
+# the background while the current one is analyzed.
+prefetchdepth=4
 
 
 # Simulation cell vectors and transformation matrix
@@ -52,72 +50,48 @@ header=" INSERT HEADER HERE"
 #print header
 
 
+# Molecules are found in the first frame and only
+# checked for proton transfers in the following ones
+topo=None
+
+
 # Loop over all shapshots in file
-for isnap in range(0,nsnap):
+for nat, comment, element, x in h2o.prefetch(h2o.iter_frames(ANIfile), depth=prefetchdepth):
     
-    snap=h2o.snapshot(nat[isnap], A, txyz[isnap], coordtype=ct)
-    allmol=h2o.cluster(nat[isnap]/napm, A, snap.tx)
-    allmol.H2Oindx
-    allmol.FindH2Os(snap.A, snap.Ainv, cutoff=OOcutoff)
-    allmol.getD(snap.A, snap.Ainv)
+    snap=h2o.snapshot(nat, A, x, coordtype=ct, element=element)
+    allmol=h2o.cluster.from_snapshot(snap, napm)
+    if topo is None:
+        topo=h2o.topology(allmol, cutoff=OOcutoff)
+    else:
+        topo.update(allmol)
 
     
-    # Construct adjacency matrix
-    Adj=np.matrix(np.zeros((allmol.nmol, allmol.nmol), dtype=np.int))
-    for imol1 in range(0, allmol.nmol-1):
-        for imol2 in range(imol1+1, allmol.nmol):
-        
-            HB=allmol.isthisHB(imol1, imol2, 1, snap.A, snap.Ainv)
-            
-            if (HB == 1):
-                Adj[imol1,imol2] = 1
-            if (HB == -1):
-                Adj[imol2,imol1] = 1
-
-    # Calculate powers of Adj
-    A1=Adj.astype(int)
-    A2=np.dot(A1,A1)
-    A3=np.dot(A1,A2)
-    A4=np.dot(A1,A3)
-    A5=np.dot(A1,A4)
-    A6=np.dot(A1,A5)
-    A7=np.dot(A1,A6)
-    A8=np.dot(A1,A7)
-    A9=np.dot(A1,A8)
-    A10=np.dot(A1,A9)
-    A11=np.dot(A1,A10)
-    A12=np.dot(A1,A11)
-    A13=np.dot(A1,A12)
-    A14=np.dot(A1,A13)
-    A15=np.dot(A1,A14)
-    #A16=np.dot(A1,A15)
-    #A17=np.dot(A1,A16)
-    #A18=np.dot(A1,A17)
-    #A19=np.dot(A1,A18)
-    #A20=np.dot(A1,A19)
+    # H-bond network of all molecules, found at once,
+    # as a sparse graph with an edge donor --> acceptor
+    donor, acceptor, hdon, rOO, theta = h2o.find_hbonds(allmol, rcut=3.5, thetacut=30.0)
+    net=hbnet.graph(allmol.nmol, donor, acceptor)
+
+    # Closed walks of length 1..15 of each molecule, 
+    # diag(Adj^k), without forming the powers of Adj
+    Nloops=hbnet.closedwalks(net, 15)
 
 
     # Get number of H-bonds and loops
     for imol in range(0,allmol.nmol):
-        Nacc = np.sum(Adj[:,imol])   # Number of accepting bonds 
-        Ndon = np.sum(Adj[imol,:])   # Number of donating bonds 
-        N3   = A3[imol,imol]         # Number of loops of length 3
-        N4   = A4[imol,imol]         # Number of loops of length 4
-        N5   = A5[imol,imol]         # Number of loops of length 5
-        N6   = A6[imol,imol]         # Number of loops of length 6
-        N7   = A7[imol,imol]         # Number of loops of length 7
-        N8   = A8[imol,imol]         # Number of loops of length 8
-        N9   = A9[imol,imol]         # Number of loops of length 9
-        N10  =A10[imol,imol]         # Number of loops of length 10
-        N11  =A11[imol,imol]         # Number of loops of length 11
-        N12  =A12[imol,imol]         # Number of loops of length 12
-        N13  =A13[imol,imol]         # Number of loops of length 13
-        N14  =A14[imol,imol]         # Number of loops of length 14
-        N15  =A15[imol,imol]         # Number of loops of length 15
-        #N16  =A16[imol,imol]         # Number of loops of length 16
-        #N17  =A17[imol,imol]         # Number of loops of length 17
-        #N18  =A18[imol,imol]         # Number of loops of length 18
-        #N19  =A19[imol,imol]         # Number of loops of length 19
-        #N20  =A20[imol,imol]         # Number of loops of length 20
+        Nacc = net.indeg[imol]       # Number of accepting bonds 
+        Ndon = net.outdeg[imol]      # Number of donating bonds 
+        N3   = Nloops[imol,2]        # Number of loops of length 3
+        N4   = Nloops[imol,3]        # Number of loops of length 4
+        N5   = Nloops[imol,4]        # Number of loops of length 5
+        N6   = Nloops[imol,5]        # Number of loops of length 6
+        N7   = Nloops[imol,6]        # Number of loops of length 7
+        N8   = Nloops[imol,7]        # Number of loops of length 8
+        N9   = Nloops[imol,8]        # Number of loops of length 9
+        N10  = Nloops[imol,9]        # Number of loops of length 10
+        N11  = Nloops[imol,10]       # Number of loops of length 11
+        N12  = Nloops[imol,11]       # Number of loops of length 12
+        N13  = Nloops[imol,12]       # Number of loops of length 13
+        N14  = Nloops[imol,13]       # Number of loops of length 14
+        N15  = Nloops[imol,14]       # Number of loops of length 15
         
-        print imol+1, Nacc, Ndon, N3, N4, N5, N6, N7, N8, N9, N10, N11, N12, N13, N14, N15 #, N16, N17, N18, N19, N20
+        print imol+1, Nacc, Ndon, N3, N4, N5, N6, N7, N8, N9, N10, N11, N12, N13, N14, N15
@@ -0,0 +1,72 @@
+#
+# Example to calculate ring statistics of the H-bond 
+# network.
+# 
+#
+import numpy as np
+import h2o
+import hbnet
+import rings
+
+
+
+######################################################################
+##############       PROGRAM    STARTS    HERE        ################
+######################################################################
+
+
+
+# Input data file
+ANIfile="./water_100steps.ANI"
+
+#number of atoms per molecule
+napm=3 
+
+
+# OO cutoff for H2O identification
+OOcutoff = 4.5  # Ang
+
+# Largest ring size
+maxsize=10
+
+# Follow H-bonds from donor to acceptor?
+directed=False
+
+
+# Simulation cell vectors and transformation matrix
+ct="cartesian"
+l=14.7222 # (Ang)
+a1=[l,0,0]
+a2=[0,l,0]
+a3=[0,0,l]
+A=np.vstack((a1,a2,a3)).T # Transpose is crucial!!
+
+
+# Header for output file. One line per frame with the
+# number of rings of each size
+print "# frame  N3  N4 ... N"+str(maxsize)
+
+
+# Molecules are found in the first frame and only
+# checked for proton transfers in the following ones
+topo=None
+
+
+# Loop over all shapshots in file
+for iframe, (nat, comment, element, x) in enumerate(h2o.prefetch(h2o.iter_frames(ANIfile))):
+    
+    snap=h2o.snapshot(nat, A, x, coordtype=ct, element=element)
+    allmol=h2o.cluster.from_snapshot(snap, napm)
+    if topo is None:
+        topo=h2o.topology(allmol, cutoff=OOcutoff)
+    else:
+        topo.update(allmol)
+
+
+    # H-bond network and its shortest-path rings
+    donor, acceptor, hdon, rOO, theta = h2o.find_hbonds(allmol, rcut=3.5, thetacut=30.0)
+    net=hbnet.graph(allmol.nmol, donor, acceptor)
+    ringlist=rings.findrings(net, maxsize, directed=directed)
+    permol, perframe = rings.ringhistograms(ringlist, allmol.nmol, maxsize)
+
+    print iframe+1, " ".join([str(N) for N in perframe[3:]])
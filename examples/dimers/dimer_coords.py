@@ -56,7 +56,7 @@ for icl in range(0,nsnap):
 
     # Create instance of the class cluster, in this
     # case containing all molecules in the snapshot
-    mycluster=h2o.cluster(nat[icl]/napm, A, snap.tx)
+    mycluster=h2o.cluster.from_snapshot(snap, napm)
     mycluster.H2Oindx
     mycluster.wrap()    
     mycluster.FindH2Os(snap.A, snap.Ainv, cutoff=4.5)    
@@ -76,7 +76,7 @@ for icl in range(0,nsnap):
     # Bring secondary molecule to positive z semispace 
     # and get 12 dimer coordinates
     mycluster.molabovexy(secondarymol)
-    xdimer=mycluster.dimercoords(centralmol, secondarymol)
+    xdimer=mycluster.dimercoords(snap.A, snap.Ainv, centralmol, secondarymol)
 
 
     # Calculate additional dimer coordinates mu, nu and d(OA, H)
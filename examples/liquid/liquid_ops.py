@@ -28,14 +28,11 @@ ANIfile="water_100steps.ANI"
 napm=3 
 
 
-# Read file
-nat=[]
-comments=[]
-txyz=[] # list of lists containing [atomtype, x,y,z]
-nat, comments, txyz = h2o.readANI(ANIfile)
-
-
-nsnap=len(nat)
+# Frames are read one at a time from the file inside
+# the loop below, so memory use does not grow with the
+# length of the trajectory. The next frames are read in
+# the background while the current one is analyzed.
+prefetchdepth=4
 
 
 # Lattice vectors and lattice matrix
@@ -52,6 +49,7 @@ A=np.vstack((a1,a2,a3)).T # Transpose is crucial!!
 
 # Calculation input
 LSIcutoff=4.50 # (Ang)
+LSIrcut=3.7    # (Ang)
 
 
 # Header for output file
@@ -61,20 +59,34 @@ header="      q              Sk             LSI(Ang^2)"
 
 
 
+# Molecules are found in the first frame and only
+# checked for proton transfers in the following ones
+topo=None
+
+
 # Loop over all shapshots in file
-for isnap in range(0,nsnap):
+for nat, comment, element, x in h2o.prefetch(h2o.iter_frames(ANIfile), depth=prefetchdepth):
     
-    snap=h2o.snapshot(nat[isnap], A, txyz[isnap], coordtype=ct)
-    allmol=h2o.cluster(nat[isnap]/napm, A, snap.tx)
-    allmol.H2Oindx
-    allmol.FindH2Os(snap.A, snap.Ainv, cutoff=LSIcutoff)
+    snap=h2o.snapshot(nat, A, x, coordtype=ct, element=element)
+    allmol=h2o.cluster.from_snapshot(snap, napm)
+    if topo is None:
+        topo=h2o.topology(allmol, cutoff=LSIcutoff)
+    else:
+        topo.update(allmol)
 
 
 #    allmol.printsnap( 'L1: '+ str(A.T[0][:])+' L2: '+ str(A.T[1][:]) +' L3: '+ str(A.T[2][:]) )        
-    for imol in range(0, allmol.nmol):
 
-        q, Sk=allmol.getTOPs(snap.A, snap.Ainv, imol)                  
-        LSI=allmol.LSI(snap.A, snap.Ainv, imol, rcutoff=3.7) 
+    # Neighbor shells built once per frame and shared by
+    # both order parameters of all molecules: at least the
+    # 4 closest oxygens (TOPs) and the first one beyond
+    # LSIrcut (LSI). Only if some shell within LSIcutoff 
+    # misses them is the search radius enlarged.
+    allmol.getshells(LSIcutoff, kmin=4, beyond=LSIrcut)
+    q, Sk=allmol.getTOPs(snap.A, snap.Ainv)
+    LSI=allmol.LSI(snap.A, snap.Ainv, rcutoff=LSIrcut)
+
+    for imol in range(0, allmol.nmol):
 
-        print q, Sk, LSI
+        print q[imol], Sk[imol], LSI[imol]
 
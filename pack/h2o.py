@@ -9,13 +9,110 @@
 # but the code structure allows any cluster size
 #
 #
+import os
+import io
 import math
+import zlib
+import bz2
+import sys
+import threading
 import numpy as np
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None   # .xz input not available
 
 
 
-class snapshot:
-    def __init__(self, Natoms, cellA, typeandcoords, coordtype='cartesian'):
+class cell(object):
+    #
+    # Periodic simulation cell with cell vectors in the 
+    # columns of A=[a1, a2, a3]. Minimum image operations
+    # for single vectors (shape (3,)) or many at once 
+    # (shape (n,3)).
+    #
+    # Orthorhombic cells (diagonal A), e.g. the cubic boxes
+    # of the examples, are detected and use a per-axis 
+    # scale-and-round minimum image with no 3x3 matrix 
+    # products. Any other cell uses the general triclinic
+    # path through fractional coordinates.
+    #
+    def __init__(self, A, Ainv=None, tol=1.0E-10):
+
+        self.A=np.asarray(A, dtype=np.float64)
+        if Ainv is None:
+            if (abs(np.linalg.det(self.A)) < 1.0E-06):
+                print "ERROR: lattice vectors are NOT linearly independent. EXIT"
+                exit()
+            Ainv=np.linalg.inv(self.A)
+        self.Ainv=np.asarray(Ainv, dtype=np.float64)
+
+        offdiag=self.A - np.diag(np.diag(self.A))
+        self.ortho=bool(np.all(np.abs(offdiag) <= tol*np.abs(self.A).max()))
+
+        # Box lengths and their inverses (orthorhombic only)
+        self.L=np.diag(self.A).copy()
+        self.Linv=np.diag(self.Ainv).copy()
+
+
+
+    def frac(self, x):
+        #
+        # Fractional (cell basis) coordinates of cartesian x
+        #
+        if self.ortho:
+            return x*self.Linv
+        return np.dot(x, self.Ainv.T)
+
+
+
+    def cart(self, s):
+        #
+        # Cartesian coordinates of fractional s
+        #
+        if self.ortho:
+            return s*self.L
+        return np.dot(s, self.A.T)
+
+
+
+    def micfrac(self, ds):
+        #
+        # Minimum image cartesian vector(s) of fractional
+        # displacement(s) ds
+        #
+        ds=ds - np.round(ds)
+        return self.cart(ds)
+
+
+
+    def mic(self, dx):
+        #
+        # Minimum image of cartesian displacement(s) dx
+        #
+        return self.micfrac(self.frac(dx))
+
+
+
+    def d(self, x1, x2):
+        #
+        # Minimum image distance(s) between x1 and x2
+        #
+        r12=self.mic(x1-x2)
+        return np.sqrt(np.sum(r12*r12, axis=-1))
+
+
+
+
+class snapshot(object):
+    def __init__(self, Natoms, cellA, typeandcoords, coordtype='cartesian', element=None):
 
         # Number of atoms in snapshot
         if (Natoms < 1):
@@ -29,49 +126,71 @@ class snapshot:
         # Notice that cell vectors must be arranged
         # in columns: A=[a1, a2, a3]
         if ( abs(np.linalg.det(cellA)) < 1.0E-6):
-            print "ERROR: number of atoms must be larger than 0. EXIT"
+            print "ERROR: lattice vectors are NOT linearly independent. EXIT"
             exit()
         else:
             self.A=cellA
             self.Ainv=np.linalg.inv(cellA)
+            self.cell=cell(self.A, self.Ainv)
         
             
         
-        # Atomic type and positions. Must be a list of lists, 
-        # each sublist containing [type,x,y,z] for each atom.
-        # The elements are of type STRING
-        if (len(typeandcoords) != Natoms):
-            print "ERROR: list must have length Natoms. EXIT"
-            exit()
+        # Atomic type and positions. Either
+        #  - element=None and typeandcoords a list of lists, 
+        #    each sublist containing [type,x,y,z] for each atom,
+        #    e.g. as returned by readANI(), or
+        #  - element an array of Natoms atom labels and 
+        #    typeandcoords an (Natoms,3) array of coordinates,
+        #    e.g. as returned by iter_frames(). The array is
+        #    used as is, without copying, if it is FLOAT.
+        if element is None:
+            if (len(typeandcoords) != Natoms):
+                print "ERROR: list must have length Natoms. EXIT"
+                exit()
+            self.element=np.array([row[0] for row in typeandcoords])
+            self.x=np.array([row[1:4] for row in typeandcoords], dtype=np.float64)
 
         else:
-            # Create first list/array row. Then append/stack
-            self.element=[typeandcoords[0][0]]
-            self.x=np.array([float(typeandcoords[0][1]),float(typeandcoords[0][2]),float(typeandcoords[0][3])])
-            for iat in range(1, self.nat):
-                self.element.append(typeandcoords[iat][0])
-                xnew=np.array([
-                        float(typeandcoords[iat][1]),float(typeandcoords[iat][2]),float(typeandcoords[iat][3])])
-                self.x=np.vstack( (self.x, xnew) )
+            self.element=np.asarray(element)
+            self.x=np.asarray(typeandcoords, dtype=np.float64)
+            if (self.x.shape != (Natoms, 3) or len(self.element) != Natoms):
+                print "ERROR: coordinates must have shape (Natoms,3) and element length Natoms. EXIT"
+                exit()
 
 
         if (coordtype=='cartesian' or coordtype=='Cartesian'):
             pass
         
         elif (coordtype=='crystal' or coordtype=='Crystal'):
-            # Convert to cartesian
-            self.x=np.dot(A,self.x.T).T
+            # Convert to cartesian. Rows of x are positions,
+            # so x_cart = (A x_cryst^T)^T = x_cryst A^T
+            self.x=np.dot(self.x, self.A.T)
         else:
             print "ERROR: unrecognized coordtype. EXIT"
             exit()
             
 
+        # List of [type,x,y,z] rows. Only built if tx is used
+        self.txcache=None
 
-        # Create tx. Mostly to interface easily (but not efficiently) with class cluster
-        self.tx=[]
-        for iat in range(0, self.nat):
-            self.tx.append([self.element[iat], self.x[iat][0], self.x[iat][1], self.x[iat][2]])
-        
+        # Fractional coordinates. Only computed if needed
+        self.scache=None
+
+
+
+
+    @property
+    def tx(self):
+        # 
+        # Atoms as a list of [type,x,y,z] rows, to interface 
+        # with code expecting the format of readANI(). Built
+        # on first use.
+        #
+        if self.txcache is None:
+            self.txcache=[ [self.element[iat], self.x[iat][0], self.x[iat][1], self.x[iat][2]]
+                           for iat in range(0, self.nat) ]
+
+        return self.txcache
 
 
 
@@ -115,23 +234,42 @@ class snapshot:
     # 5) calculate euclidean distance
     # 
     
-        sij=np.dot(self.Ainv, self.x[i]-self.x[j])
-        sij[:]=sij[:] - np.round(sij[:])
-        rij=np.dot(self.A,sij)
+        # Steps 2) and 4) are a per-axis scaling for 
+        # orthorhombic cells. Otherwise the fractional
+        # coordinates are computed once for all atoms.
+        if self.cell.ortho:
+            rij=self.cell.mic(self.x[i]-self.x[j])
+        else:
+            s=self.getfrac()
+            rij=self.cell.micfrac(s[i]-s[j])
         return math.sqrt( np.dot(rij,rij) )
 
 
+
+    def getfrac(self):
+        #
+        # Fractional coordinates of all atoms, computed
+        # once and reused
+        #
+        if self.scache is None:
+            self.scache=self.cell.frac(self.x)
+
+        return self.scache
+
+
                              
 
 
-class cluster:    
+class cluster(object):    
     #############################
     # class cluster variables
     #############################
-    def __init__(self, Nmolecules, cellA, typeandcoords):
+    def __init__(self, Nmolecules, cellA, typeandcoords, element=None, Ainv=None):
         
 
-        # Number of molecules in cluster
+        # Number of molecules in cluster. If other atoms
+        # than water are present, the actual number of water
+        # molecules is set by FindH2Os()
         if (Nmolecules < 1):
             print "ERROR: number of molecules must be larger than 0."
         else:
@@ -139,36 +277,73 @@ class cluster:
             self.nat = 3*self.nmol
         
 
-        # Matrix containing lattice vectors
-        if (abs(np.linalg.det(cellA)) < 1.0E-06):
+        # Matrix containing lattice vectors. The inverse
+        # can be passed in Ainv if it is already known.
+        if Ainv is not None:
+            self.A = cellA
+            self.Ainv = Ainv
+        elif (abs(np.linalg.det(cellA)) < 1.0E-06):
             print "ERROR: lattice vectors are NOT linearly independent. EXIT"
             exit()
         else:
             self.A = cellA
             self.Ainv=np.linalg.inv(cellA)
 
+        self.cell=cell(self.A, self.Ainv)
+
+
+        # Atomic type and positions. Either
+        #  - element=None and typeandcoords a list of lists, 
+        #    each sublist containing [type,x,y,z] for each atom, or
+        #  - element an array of atom labels and typeandcoords
+        #    an (nat,3) array of coordinates. The array is shared,
+        #    not copied (see from_snapshot).
+        if element is None:
+            if (len(typeandcoords) != 3*Nmolecules):
+                print "ERROR: list alat must have length 3*number_of_molecules."
+            self.txcache = typeandcoords
+            self.element = np.array([row[0] for row in typeandcoords])
+            self.x = np.array([row[1:4] for row in typeandcoords], dtype=np.float64)
+            self.xshared = False
 
-        # Atomic type and positions. Must be a list of lists, 
-        # each sublist containing [type,x,y,z] for each atom.
-        # The elements are of type STRING
-        if (len(typeandcoords) != 3*Nmolecules):
-            print "ERROR: list alat must have length 3*number_of_molecules."
         else:
-            self.tx = typeandcoords
+            if (len(typeandcoords) != len(element)):
+                print "ERROR: coordinate and element arrays must have the same length."
+            self.txcache = None
+            self.element = np.asarray(element)
+            self.x = np.asarray(typeandcoords, dtype=np.float64)
+            self.xshared = True
 
-        # All atomic coordinates.
-        # The elements are a numpy.array of FLOAT
-        self.x=[]
-        for iat in range(0, self.nat):
-            self.x.append(np.array([
-                        float(self.tx[iat][1]),float(self.tx[iat][2]),float(self.tx[iat][3]) ]))             
+        # All atomic coordinates, an (nat,3) numpy.array 
+        # of FLOAT. x[iat] is the position of atom iat.
+        self.nat = len(self.x)
+
+        # Fractional coordinates and O-O neighbor shells,
+        # computed once if needed. Reset whenever x changes.
+        self.scache = None
+        self.shells = None
 
 
-        # Index lists for Oxygens, Hydrogens and H2Os
+        # Element codes (atomic numbers) of all atoms. 
+        # Set by FindAtoms()
+        self.ecode=None
+
+
+        # Index arrays for Oxygens, Hydrogens, other atoms
+        # and H2Os. H2Oindx is an (nmol,3) array with the
+        # [O, H1, H2] atom indices of each molecule
         #
-        self.Oindx=[]
-        self.Hindx=[]
-        self.H2Oindx=[]
+        self.Oindx=np.zeros(0, dtype=np.int32)
+        self.Hindx=np.zeros(0, dtype=np.int32)
+        self.otherindx=np.zeros(0, dtype=np.int32)
+        self.H2Oindx=np.zeros([0,3], dtype=np.int32)
+
+        # Atoms that do not fit in the H2O molecules found 
+        # by FindH2Os: Hs given to more than one O, Hs given
+        # to none and Os with less than two Hs
+        self.Hshared=np.zeros(0, dtype=np.int32)
+        self.Hunassigned=np.zeros(0, dtype=np.int32)
+        self.Odefects=np.zeros(0, dtype=np.int32)
 
         
         # Arrays for interatomic distances. 
@@ -184,7 +359,108 @@ class cluster:
         self.rad2deg=180.0/math.pi
         
 
-        
+
+
+    @classmethod
+    def from_snapshot(cls, snap, napm=3):
+        #
+        # Cluster with all the atoms of snapshot snap, 
+        # napm atoms per molecule. The coordinates and the
+        # cell matrix and its inverse are shared with snap,
+        # not parsed or copied again. Coordinates are only
+        # copied if the cluster is later modified in place
+        # (translations, rotations, swaps...).
+        #
+        return cls(snap.nat//napm, snap.A, snap.x, element=snap.element, Ainv=snap.Ainv)
+
+
+
+    @property
+    def tx(self):
+        #
+        # Atoms as a list of [type,x,y,z] rows. Built on
+        # first use if the cluster was made from arrays.
+        #
+        if self.txcache is None:
+            self.txcache=[ [self.element[iat], self.x[iat][0], self.x[iat][1], self.x[iat][2]]
+                           for iat in range(0, self.nat) ]
+
+        return self.txcache
+
+
+
+    def ownx(self):
+        #
+        # Make a private copy of shared coordinates (and atom
+        # labels) before modifying them in place, so that the snapshot (or
+        # memory mapped trajectory) they come from is left
+        # untouched.
+        #
+        if self.xshared:
+            self.x=np.array(self.x)
+            self.element=np.array(self.element)
+            self.xshared=False
+
+        return
+
+
+
+    def getcell(self, A, Ainv):
+        #
+        # Cell object for the A, Ainv passed to the PBC
+        # methods. These are normally the cluster's own.
+        #
+        if (A is self.A or np.array_equal(A, self.A)):
+            return self.cell
+
+        return cell(A, Ainv)
+
+
+
+    def getfrac(self):
+        #
+        # Fractional coordinates of all atoms, computed
+        # once per frame and reused by the PBC methods
+        #
+        if self.scache is None:
+            self.scache=self.cell.frac(self.x)
+
+        return self.scache
+
+
+
+    def getpairs(self, rcut, indx1=None, indx2=None, nlist=None):
+        #
+        # Pairs of atoms within distance rcut, found with
+        # the linked-cell search of neighborpairs() in O(N).
+        #
+        #  - indx1: atom indices of the first set. All atoms if None
+        #  - indx2: atom indices of the second set. If None, 
+        #           pairs within the first set (each once)
+        #  - nlist: optional verletlist kept across frames for 
+        #           these same atom sets. Its cutoff is used
+        #           instead of rcut
+        #
+        # Returns atom indices i, j, minimum image vectors
+        # x[j]-x[i] and distances, as neighborpairs().
+        #
+        if indx1 is None:
+            indx1=np.arange(self.nat)
+
+        x1=self.x[indx1]
+        x2=None if indx2 is None else self.x[indx2]
+
+        if nlist is None:
+            i, j, r, d = neighborpairs(self.cell, x1, rcut, x2)
+        else:
+            i, j, r, d = nlist.update(self.cell, x1, x2)
+
+        if indx2 is None:
+            return indx1[i], indx1[j], r, d
+
+        return indx1[i], indx2[j], r, d
+
+
 
     #############################
     # class cluster functions
@@ -220,9 +496,15 @@ class cluster:
     # 
     
         
-        sij=np.dot(Ainv, self.x[i]-self.x[j] )
-        sij[:]=sij[:] - np.round(sij[:])
-        rij=np.dot(A, sij)
+        # Steps 2) and 4) are a per-axis scaling for 
+        # orthorhombic cells. Otherwise the fractional
+        # coordinates are computed once for all atoms.
+        c=self.getcell(A, Ainv)
+        if (c is self.cell and not c.ortho):
+            s=self.getfrac()
+            rij=c.micfrac(s[i]-s[j])
+        else:
+            rij=c.mic(self.x[i]-self.x[j])
         return np.sqrt( np.dot(rij,rij) )
 
 
@@ -236,8 +518,10 @@ class cluster:
         if (R.shape[0] != 3):
             print "ERROR: translation array R has wrong properties"
         else:
-            for iat in range(0, self.nat):
-                self.x[iat] = self.x[iat] + R
+            # New array: shared coordinates are left untouched
+            self.x = self.x + R
+            self.scache = None
+            self.shells = None
         
         return
  
@@ -251,28 +535,17 @@ class cluster:
         # Return 1 if wrapped, 0 if not wrapped
         #
         
-        status=1
-        
         min=-0.5
         max= 0.5
  
-        for iat in range(0, self.nat):
+        # Position vectors of all atoms in basis where the 
+        # simulation box is a cube of unit length
+        sx=self.getfrac()
 
-            # Position vector in basis where the simulation box 
-            # is a cube of unit length
-            sx=np.dot(self.Ainv, self.x[iat])
-                        
-            if (sx[0] > max or sx[0] < min):
-                status=0
-                break
-            
-            if (sx[1] > max or sx[1] < min):
-                status=0
-                break
-            
-            if (sx[2] > max or sx[2] < min):
-                status=0
-                break
+        if (np.all(sx >= min) and np.all(sx <= max)):
+            status=1
+        else:
+            status=0
 
         return status
 
@@ -369,46 +642,21 @@ class cluster:
 
 
     def FindAtoms(self):
-        # Loop over all atoms. Everytime an O is found,
-        # scan all Hs and find the two closest.
-        
-        # Initialize distances to some huge number,
-        # d1<=d2
-        d1=1.0E+30 
-        d2=1.1E+30
-        
-
-        # Atom type labels
-        Olabel='O'
-        Hlabel='H'
-
-        # Indices containing Oxygens and Hydrogens
-        Oind=[]
-        Hind=[]
-        
-        err=0
-        # Find indices for Oxygens and Hydrogens
-        for iat in range(0, self.nat):
-            if (self.tx[iat][0] == Olabel):
-                Oind.append(iat)
-            elif(self.tx[iat][0] == Hlabel):
-                Hind.append(iat)
-            else:
-                print "ERROR: Atom label with index ", iat, " is not O nor H."
-                err=1
-                break
-                
-        nO=len(Oind)
-        nH=len(Hind)
-        #print "DEBUG-- ", nO, " Oxygens found with indices ", Oind
-        #print "DEBUG-- ", nH, " Hydrogens found with indices ", Hind
+        #
+        # Index arrays of Oxygens and Hydrogens from the
+        # element codes (atomic numbers) of all atoms. 
+        # Any other atoms (ions, solutes...) are collected
+        # in otherindx.
+        #
+        if self.ecode is None:
+            self.ecode=elementcode(self.element)
 
-        
-        self.Oindx=Oind
-        self.Hindx=Hind
+        self.Oindx=np.flatnonzero(self.ecode == 8).astype(np.int32)
+        self.Hindx=np.flatnonzero(self.ecode == 1).astype(np.int32)
+        self.otherindx=np.flatnonzero((self.ecode != 8) & (self.ecode != 1)).astype(np.int32)
 
         # return 0 if success, 1 if error
-        return err
+        return 0
 
 
 
@@ -421,45 +669,82 @@ class cluster:
         #
         # cutoff (same units as coordinates): leaves outside 
         # the possible O-H bonds any pair with distance beyond
-        # the cutoff value. For computational efficiency when
-        # large cells with many atoms
+        # the cutoff value. Candidate pairs are found in O(N)
+        # with a linked-cell search.
+        #
+        # Each O gets its two closest Hs. Os with less than
+        # two Hs within the cutoff are not made into molecules
+        # and are listed in self.Odefects. Hs assigned to two
+        # Os are listed in self.Hshared and Hs assigned to
+        # none in self.Hunassigned (e.g. hydronium and 
+        # hydroxide defects).
+        #
+        # The molecule table is rebuilt from scratch, so 
+        # calling this again (e.g. for a new frame) replaces
+        # it instead of appending to it.
         #
         err=self.FindAtoms()
 
-        if (len(self.Oindx)<1 or len(self.Hindx)<2):
+        if (err==0 and len(self.Oindx)==0):
+            # No Os (e.g. a frame of ions or solutes only):
+            # no molecules, and every H is unassigned
+            self.H2Oindx=np.zeros((0,3), dtype=np.int32)
+            self.nmol=0
+            self.Hshared=np.zeros(0, dtype=np.int32)
+            self.Hunassigned=self.Hindx
+            self.Odefects=np.zeros(0, dtype=np.int32)
+
+        elif (len(self.Oindx)<1 or len(self.Hindx)<2):
             print "ERROR: index lists for Os and Hs don't have correct length. Possibly FindAtoms() has not been called."
 
         elif (err==0):
 
-            for iO in self.Oindx:            
-                
-                # Find all possible O-H distances for the current O
-                indices=[] 
-                distances=[]
-                for iH in self.Hindx:
-
-                    daux=self.d_PBC(A, Ainv, iO , iH)                    
-                    
-
-                    if (daux < cutoff):
-                        indices.append(iH)
-                        distances.append(daux)
-                
-
-                nH=2 # two Hydrogens per molecule
-                hydrogens=[]
-                # Form molecule by assigning H's with smallest O-H distance
-                #for iH in range(0, alen(self.Hindx)):
-                for iH in range(0, nH):
-
-                    imin=distances.index(min(distances))
-                    distances.pop(imin)
-                    hydrogens.append(indices.pop(imin))
-
-        
-                # Add molecule
-                self.H2Oindx.append([iO] + hydrogens)
-
+            # All O-H pairs within the cutoff, from a linked-cell
+            # search. Pairs come sorted by O and then by H.
+            c=self.getcell(A, Ainv)
+            pO, pH, r, dOH = neighborpairs(c, self.x[self.Oindx], cutoff, self.x[self.Hindx])
+            keep= dOH < cutoff
+            pO=pO[keep]
+            pH=self.Hindx[pH[keep]]
+            dOH=dOH[keep]
+
+            nO=len(self.Oindx)
+            first=np.searchsorted(pO, np.arange(nO+1))
+            count=np.diff(first)
+
+
+            # Candidate distances and Hs of each O as rows of
+            # (nO, ncandidates) tables, padded with inf
+            width=max(count.max(), 2)
+            col=np.arange(len(pO)) - first[pO]
+            dtab=np.empty((nO, width))
+            dtab.fill(np.inf)
+            dtab[pO, col]=dOH
+            htab=np.zeros((nO, width), dtype=np.int32)
+            htab[pO, col]=pH
+
+
+            # Two closest Hs of each O, closest first
+            rows=np.arange(nO)[:,np.newaxis]
+            two=np.argpartition(dtab, 1, axis=1)[:,:2]
+            d2=dtab[rows, two]
+            flip= (d2[:,1] < d2[:,0]) | ((d2[:,1] == d2[:,0]) & (two[:,1] < two[:,0]))
+            two[flip]=two[flip][:,::-1]
+            hydrogens=htab[rows, two]
+
+
+            # (nmol,3) table of molecules. Row imol holds the 
+            # indices of the O and the two Hs of molecule imol
+            ok= count >= 2
+            self.H2Oindx=np.column_stack((self.Oindx, hydrogens))[ok].astype(np.int32)
+            self.nmol=len(self.H2Oindx)
+
+
+            # Atoms left out or assigned twice
+            nassigned=np.bincount(self.H2Oindx[:,1:].ravel(), minlength=self.nat)[self.Hindx]
+            self.Hshared=self.Hindx[nassigned > 1]
+            self.Hunassigned=self.Hindx[nassigned == 0]
+            self.Odefects=self.Oindx[~ok]
 
         return
 
@@ -608,11 +893,12 @@ class cluster:
 
     def EulerAll(self, alpha, beta, gamma):
         #
-        # Euler rotation on all atoms
+        # Euler rotation on all atoms. Rows of x are
+        # positions, so x' = (R x^T)^T = x R^T
         #
-        for iat in range(0, self.nat):
-            aux=self.Euler(alpha, beta, gamma, self.x[iat])
-            self.x[iat]=aux
+        self.x=np.dot(self.x, self.EulerMat(alpha, beta, gamma).T)
+        self.scache=None
+        self.shells=None
         return
 
 
@@ -624,8 +910,7 @@ class cluster:
         # CAUTION: most probably the system wants to be translated to
         #          a reference origin before performing the rotation.
         #
-        for iat in range(0, self.nat):
-            self.x[iat] = Euler(alpha, beta, gamma, self.x[iat])
+        self.EulerAll(alpha, beta, gamma)
 
         return
 
@@ -637,11 +922,8 @@ class cluster:
         # Calculates the vector b-a with PBC
         #
 
-        # Minimum image conversion                                                                                                              
-        ab=b-a
-        sab=np.dot(Ainv, ab)
-        sab[:]=sab[:] - np.round(sab[:])
-        ab=np.dot(A,sab)
+        # Minimum image conversion
+        ab=self.getcell(A, Ainv).mic(b-a)
         
         return ab
 
@@ -699,13 +981,9 @@ class cluster:
         
         
         # Minimum image conversion
-        s1=np.dot(Ainv, v1)
-        s1[:]=s1[:] - np.round(s1[:])
-        v1=np.dot(A,s1)
-        
-        s2=np.dot(Ainv, v2)
-        s2[:]=s2[:] - np.round(s2[:])
-        v2=np.dot(A,s2)
+        c=self.getcell(A, Ainv)
+        v1=c.mic(v1)
+        v2=c.mic(v2)
 
 
         # Calculate angle
@@ -734,7 +1012,7 @@ class cluster:
         print "\t", self.nat
         print comment
         for iat in range(0, self.nat):
-            print self.tx[iat][0], "\t", self.x[iat][0], "\t", self.x[iat][1], "\t", self.x[iat][2]
+            print self.element[iat], "\t", self.x[iat][0], "\t", self.x[iat][1], "\t", self.x[iat][2]
 
         return
 
@@ -748,7 +1026,7 @@ class cluster:
         print "\t", self.nat+1
         print comment
         for iat in range(0, self.nat):
-            print self.tx[iat][0], "\t", self.x[iat][0], "\t", self.x[iat][1], "\t", self.x[iat][2]
+            print self.element[iat], "\t", self.x[iat][0], "\t", self.x[iat][1], "\t", self.x[iat][2]
 
         print "He", "\t", u[0], "\t", u[1], "\t", u[2]
             
@@ -874,8 +1152,8 @@ class cluster:
        
         # (1)
         
-        if not self.H2Oindx:
-            self.FindH2Os
+        if (len(self.H2Oindx) == 0):
+            self.FindH2Os(self.A, self.Ainv)
         
         iO=self.H2Oindx[molindex][0]
         iH1=self.H2Oindx[molindex][1]
@@ -925,8 +1203,9 @@ class cluster:
         # Apply a mirror reflection about xy plane
         # to all atomic coordinates
        
-        for iat in range(0, self.nat):
-            self.x[iat][2] = -1.0*self.x[iat][2]
+        self.x = self.x * np.array([1.0, 1.0, -1.0])
+        self.scache = None
+        self.shells = None
 
         return
 
@@ -979,10 +1258,10 @@ class cluster:
 
             
 
-            i11=3*imol1+1
-            i12=3*imol1+2
-            i21=3*imol2+1
-            i22=3*imol2+2
+            i11=self.H2Oindx[imol1,1]
+            i12=self.H2Oindx[imol1,2]
+            i21=self.H2Oindx[imol2,1]
+            i22=self.H2Oindx[imol2,2]
 
 
             
@@ -990,10 +1269,11 @@ class cluster:
             #rOH12=self.d_PBC(A, Ainv, self.x[self.H2Oindx[imol1][0]], self.x[i12] )
             #rOH21=self.d_PBC(A, Ainv, self.x[self.H2Oindx[imol2][0]], self.x[i21] )
             #rOH22=self.d_PBC(A, Ainv, self.x[self.H2Oindx[imol2][0]], self.x[i22] )
-            rOH11=d_PBC(A, Ainv, self.x[self.H2Oindx[imol1][0]], self.x[i11] )
-            rOH12=d_PBC(A, Ainv, self.x[self.H2Oindx[imol1][0]], self.x[i12] )
-            rOH21=d_PBC(A, Ainv, self.x[self.H2Oindx[imol2][0]], self.x[i21] )
-            rOH22=d_PBC(A, Ainv, self.x[self.H2Oindx[imol2][0]], self.x[i22] )
+            c=self.getcell(A, Ainv)
+            rOH11=d_PBC(c, None, self.x[self.H2Oindx[imol1][0]], self.x[i11] )
+            rOH12=d_PBC(c, None, self.x[self.H2Oindx[imol1][0]], self.x[i12] )
+            rOH21=d_PBC(c, None, self.x[self.H2Oindx[imol2][0]], self.x[i21] )
+            rOH22=d_PBC(c, None, self.x[self.H2Oindx[imol2][0]], self.x[i22] )
             
 
             # intramolecular angles
@@ -1005,13 +1285,11 @@ class cluster:
             # O coordinates 
             # distance
             #rOO=self.d_PBC(A, Ainv, self.x[self.H2Oindx[imol1][0]], self.x[self.H2Oindx[imol2][0]])
-            rOO=d_PBC(A, Ainv, self.x[self.H2Oindx[imol1][0]], self.x[self.H2Oindx[imol2][0]])
+            rOO=d_PBC(c, None, self.x[self.H2Oindx[imol1][0]], self.x[self.H2Oindx[imol2][0]])
 
             # angles -- need to apply PBCs to correclty get direction vector
             u=self.x[self.H2Oindx[imol2][0]] - self.x[self.H2Oindx[imol1][0]]
-            us=np.dot(Ainv, u)
-            us[:]=us[:] - np.round(us[:])
-            u=np.dot(A,us)
+            u=c.mic(u)
             u=self.normalize(u)
             
             phi, theta = self.phitheta(u)
@@ -1057,20 +1335,26 @@ class cluster:
     
     def swap(self, i,j):
         #
-        # Swap atoms i and j in the cluster
-        #
-        
-        natpmol = self.nat/self.nmol
-        
-        molindxi = i // natpmol
-        atindxi = i - molindxi * natpmol
-
-        molindxj = j // natpmol
-        atindxj = j - molindxj * natpmol
-
-        self.H2Oindx[molindxi][atindxi], self.H2Oindx[molindxj][atindxj] = self.H2Oindx[molindxj][atindxj], self.H2Oindx[molindxi][atindxi] 
-        self.tx[i], self.tx[j] = self.tx[j], self.tx[i]
-        self.x[i], self.x[j] = self.x[j], self.x[i]
+        # Swap atoms i and j in the cluster. The index 
+        # arrays (H2Oindx, Oindx...) are renumbered, so 
+        # every molecule keeps its atoms.
+        #
+        perm=np.arange(self.nat, dtype=np.int32)
+        perm[i], perm[j] = j, i
+        self.H2Oindx=perm[self.H2Oindx]
+        self.Oindx=perm[self.Oindx]
+        self.Hindx=perm[self.Hindx]
+        self.otherindx=perm[self.otherindx]
+
+        if self.txcache is not None:
+            self.txcache[i], self.txcache[j] = self.txcache[j], self.txcache[i]
+        self.ownx()
+        self.element[[i,j]] = self.element[[j,i]]
+        if self.ecode is not None:
+            self.ecode[[i,j]] = self.ecode[[j,i]]
+        self.x[[i,j]] = self.x[[j,i]]
+        self.scache = None
+        self.shells = None
         
         return
         
@@ -1168,6 +1452,9 @@ class cluster:
         #       in the O-O RDF (==3.5 Ang)
         #  (ii) The angle Oa-Od-Hd < theta^cut_OOH == 30deg
         #
+        # Any other HBdef is looked up in the registry of 
+        # H-bond definitions hbdefs (see register_hbdef)
+        #
         #
         # OUTPUT:
         #   HB ==  1 if imol1 and imol2 are H-bonded and imol1 is DONOR
@@ -1201,16 +1488,16 @@ class cluster:
 
 
             # Check (i) and (ii)
-            if (self.D[iO1][iO2] <= r_cut): # Distance requirement passed.
+            if (self.Dij(iO1, iO2) <= r_cut): # Distance requirement passed.
 
                 
                 # Now establish possible H-bond and check angles.
 
                 # Get all 4 INTERMOLECULAR O-H distances
-                d121=self.D[iO1][iH21]
-                d122=self.D[iO1][iH22]
-                d211=self.D[iO2][iH11]
-                d212=self.D[iO2][iH12]
+                d121=self.Dij(iO1, iH21)
+                d122=self.Dij(iO1, iH22)
+                d211=self.Dij(iO2, iH11)
+                d212=self.Dij(iO2, iH12)
                 alld=[d121,d122,d211,d212]
                 
                 # Minimum intramolecular O-H distance determines possible 
@@ -1266,6 +1553,13 @@ class cluster:
             else:
                 HB = 0
 
+        elif HBdef in hbdefs:
+
+            # Any other registered definition
+            g=hbgeometry(self, pairs=([imol1], [imol2]), c=self.getcell(A, Ainv))
+            if hbdefs[HBdef][0](g)[0]:
+                HB = 1 if (g.donor[0] == imol1) else -1
+
         else:
             print "HBtype not recognized. Exiting..."
             exit()
@@ -1283,9 +1577,14 @@ class cluster:
         # Call this function after calling findHB()
         #
         
-        if (primaryh == 2 or primaryh == 5):
+        irow=np.flatnonzero(self.H2Oindx[:,2] == primaryh)
+
+        if (len(irow) > 0):
 
+            # Exchange the two Hs and their places in the 
+            # molecule, so the donated H is the first one
             self.swap(primaryh, secondaryh)
+            self.H2Oindx[irow[0],1:]=self.H2Oindx[irow[0],2:0:-1]
             primaryh, secondaryh = secondaryh, primaryh
 
 
@@ -1322,8 +1621,8 @@ class cluster:
         
         
         # Find Oxygen indices from molecule indices
-        iDO = 3*iD ### + 0 # because O is the first atom in the triplet (O,H1,H2)
-        iAO = 3*iA ### + 0
+        iDO = self.H2Oindx[iD,0]
+        iAO = self.H2Oindx[iA,0]
 
     
         # Get coordinates
@@ -1386,71 +1685,60 @@ class cluster:
 
 
 
-    def getD(self, A, Ainv):
+    def getD(self, A, Ainv, tile=None, dtype=np.float64, condensed=False):
         #
         # Calculate D, the matrix of interatomic
-        # distances. This is a symmetric matrix with
-        # zero diagonal so we only need to calculate 
-        # the distances for i2<i1
+        # distances, with the tiled kernel pbcdistances().
         #
-        # Initialize matrix
-        if (np.all(self.D)==False):
-            self.D=np.zeros([self.nat,self.nat] )
-        
-
-        # Fill lower triangle of matrix
-        for i1 in range(0,self.nat):
-            i2=0
-            while i2 < i1:
-                if (i2==i1):
-                    pass
-                else:
-                    self.D[i1][i2]=self.d_PBC(A, Ainv, i1, i2)
-                
-                i2+=1
-        
-        
-        # Fill upper triangle of (symmetric, zero diagonal) matrix
-        self.D=self.D + self.D.T
+        # tile      : number of rows computed at once. Bounds
+        #             the temporary memory. Automatic if None
+        # dtype     : storage type of D, e.g. np.float32 to 
+        #             halve its memory
+        # condensed : store only the upper triangle (i<j) as
+        #             a 1d array of length nat*(nat-1)/2. Use
+        #             Dij() to read entries in either format
+        #
+        c=self.getcell(A, Ainv)
+        self.D=pbcdistances(c, self.x, tile=tile, dtype=dtype, condensed=condensed)
         
         return
 
 
 
-    def OOdists(self, A, Ainv):
+    def Dij(self, i, j):
         #
-        # Calculate matrix of O-O distances.
+        # Distance between atoms i and j from D, stored
+        # either as a full matrix or condensed
         #
+        if (np.ndim(self.D) == 2):
+            return self.D[i][j]
 
+        if (i == j):
+            return 0.0
+        if (i > j):
+            i, j = j, i
 
-        # If D has not been created yet
-        if (np.size(self.D) != self.nat**2):
+        return self.D[self.nat*i - (i*(i+1))//2 + j - i - 1]
 
-            if (np.size(self.rOO) != len(self.Oindx)**2 ):
-                self.rOO=np.zeros( [len(self.Oindx), len(self.Oindx)] )
-                
 
-        
-            # Fill lower triangle of matrix
-            for iO1 in range(0,len(self.Oindx)):
-                iO2=0
-                while iO2 < iO1:
-                    if (iO2==iO1):
-                        pass
-                    else:
-                        self.rOO[iO1][iO2]=self.d_PBC(A, Ainv, self.Oindx[iO1], self.Oindx[iO2])
-                
-                    iO2+=1
+
+    def OOdists(self, A, Ainv, tile=None, dtype=np.float64):
+        #
+        # Calculate matrix of O-O distances.
+        #
 
 
-            # Fill upper triangle of (symmetric, zero diagonal) matrix
-            self.rOO=self.rOO + self.rOO.T
+        # If the full D has not been created yet
+        if (np.size(self.D) != self.nat**2):
+
+            c=self.getcell(A, Ainv)
+            self.rOO=pbcdistances(c, self.x[self.Oindx], tile=tile, dtype=dtype)
         
 
         # If D already exists
         else:
             # Take from D the O-O submatrix 
-            self.rOO=self.D[self.Oindx,:][:,self.Oindx]
+            self.rOO=self.D[np.ix_(self.Oindx, self.Oindx)]
         
         return
 
@@ -1499,7 +1787,35 @@ class cluster:
 
 
 
-    def getTOPs(self, A, Ainv, imolcentral):
+    def getshells(self, rmax=4.5, kmin=0, beyond=None, nlist=None):
+        #
+        # Sorted O-O neighbor shells of all molecules (see
+        # neighborshells), in the order of Oindx. Computed 
+        # once per frame and shared by getTOPs, LSI and any
+        # other shell-based analysis. A new search is only
+        # done if the cached shells are too small for rmax,
+        # kmin or beyond.
+        #
+        #  - nlist: optional verletlist of the oxygens, 
+        #           kept across frames
+        #
+        if (len(self.Oindx) == 0):
+            self.FindAtoms()
+
+        sh=self.shells
+        if (sh is None or sh.rmax < rmax or not sh.complete(kmin, beyond)):
+            # New shells at least as large as the cached ones,
+            # so they still serve earlier requests
+            if sh is not None:
+                rmax=max(rmax, sh.rmax)
+            self.shells=neighborshells(self.cell, self.x[self.Oindx], rmax,
+                                       kmin=kmin, beyond=beyond, nlist=nlist)
+
+        return self.shells
+
+
+
+    def getTOPs(self, A, Ainv, imolcentral=None):
         #
         # Wrapper to obtain Tetrahedral Order Parameters
         # - Orientational Tetrahedral Order (TOP)
@@ -1509,66 +1825,98 @@ class cluster:
         # - A is the cell-->cartesian basis change matrix
         # - Ainv is the inverse of A
         # - imolcentral is the molecule index of the molecule
-        #   in the cluster for which TOPs are being calculated
+        #   in the cluster for which TOPs are being calculated.
+        #   If None, arrays with the TOPs of all molecules 
+        #   are returned
         #
+        # The 4 closest oxygens come from the cached
+        # neighbor shells (getshells)
+        #
+        shells=self.getshells(rmax=3.5, kmin=4)
+        nbr, d, r = shells.knn(4)
 
-        # Calculate O-O distances if needed
-        if (np.size(self.rOO) != len(self.Oindx)**2 ):
-            self.OOdists(A, Ainv)
-
-    
-        # calculate Orientational Tetrahedral Order parameter
-        # self.rOO[imolcentral][:].argsort()[1:5] gets the
-        # indices of the 4 smallest O-O distances
-        q=self.OTO(A, Ainv, self.Oindx[imolcentral], self.rOO[imolcentral][:].argsort()[1:5] )
 
+        if imolcentral is not None:
 
+            # calculate Orientational Tetrahedral Order parameter
+            # from the indices of the 4 closest oxygens
+            q=self.OTO(A, Ainv, self.Oindx[imolcentral], nbr[imolcentral])
 
-        # calculate Translational Tetrahedral Order parameter
-        # np.sort(self.rOO[imolcentral][:])[1:5] takes the 4
-        # smallest O-O distances for the given molecule
-        Sk=self.TTO(np.sort(np.copy(self.rOO[imolcentral][:]))[1:5])
+            # calculate Translational Tetrahedral Order parameter
+            # from the 4 smallest O-O distances
+            Sk=self.TTO(d[imolcentral])
 
-        return q, Sk
+            return q, Sk
 
 
+        # All molecules at once. cos(psi_jk) for the 6 pairs
+        # of the 4 vectors to the closest oxygens
+        u=r/d[:,:,np.newaxis]
+        cospsi=np.einsum('nji,nki->njk', u, u)
+        j, k = np.triu_indices(4, 1)
+        q=1.0 - (3.0/8.0)*np.sum((1.0/3.0 + cospsi[:,j,k])**2, axis=1)
 
+        mean=np.sum(d, axis=1)/4.0
+        aux=d - mean[:,np.newaxis]
+        Sk=1.0 - 1.0/(12.0*mean**2) * np.sum(aux*aux, axis=1)
 
+        return q, Sk
 
-    def LSI(self, A, Ainv, imolcentral, rcutoff=3.7):
-        # Calculate local structure index
 
 
 
-        # Calculate O-O distances if needed                                                                                                              
-        if (np.size(self.rOO) != len(self.Oindx)**2 ):
-            self.OOdists(A, Ainv)
 
+    def LSI(self, A, Ainv, imolcentral=None, rcutoff=3.7):
+        # Calculate local structure index. If imolcentral is 
+        # None, return an array with the LSI of all molecules.
+        #
+        # Sorted O-O distances come from the cached neighbor 
+        # shells (getshells), which reach at least the first
+        # molecule beyond rcutoff.
 
+        shells=self.getshells(rmax=rcutoff, beyond=rcutoff)
 
-        # Select distances and sort them in place
-        dists=np.copy(self.rOO[imolcentral][:])   # np.copy is important. Otherwise sort
-        dists.sort()                              # command on this line will sort the
-        dists=np.delete(dists,0)                  # original array!!
 
+        if imolcentral is not None:
 
+            # Sorted distances to all other molecules in the shell
+            nbr, dists, r = shells.shell(imolcentral)
 
-        # lesser than cutoff?
-        ltc= dists < rcutoff
+            # lesser than cutoff?
+            ltc= dists < rcutoff
 
-        # First molecule beyond cutoff radius needs to be included 
-        nt=sum(ltc)
-        ltc[nt]=True
+            # First molecule beyond cutoff radius needs to be included 
+            nt=sum(ltc)
+            ltc[nt]=True
 
 
-        # Eliminate unnecessary array elements
-        dists=dists[ltc]
+            # Eliminate unnecessary array elements
+            dists=dists[ltc]
         
         
-        delta=dists[1:len(dists)] - dists[0:len(dists)-1]
-        mean=np.sum(delta)/len(delta)
+            delta=dists[1:len(dists)] - dists[0:len(dists)-1]
+            mean=np.sum(delta)/len(delta)
+
+            return np.sum((delta-mean)**2)/len(delta)
+
+
+        # All molecules at once. Position of each distance 
+        # within its shell, and number nt below the cutoff
+        n=shells.n
+        pos=np.arange(len(shells.d)) - shells.start[shells.center]
+        nt=np.bincount(shells.center, weights=(shells.d < rcutoff), minlength=n)
+
+        # Gaps between consecutive distances, up to and 
+        # including the first one beyond the cutoff
+        gap= (pos >= 1) & (pos <= nt[shells.center])
+        idx=np.flatnonzero(gap)
+        delta=shells.d[idx] - shells.d[idx-1]
+        mol=shells.center[idx]
 
-        return np.sum((delta-mean)**2)/len(delta)
+        mean=np.bincount(mol, weights=delta, minlength=n)/nt
+        dev=delta - mean[mol]
+
+        return np.bincount(mol, weights=dev*dev, minlength=n)/nt
         
 
 
@@ -1587,6 +1935,51 @@ class cluster:
 #################################
 
 
+# Chemical symbols ordered by atomic number. Element
+# codes are atomic numbers, with 0 for unknown labels.
+elementsymbols=( 'X H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca '
+                 'Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr '
+                 'Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe '
+                 'Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb Lu '
+                 'Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn '
+                 'Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr '
+                 'Rf Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og' ).split()
+
+elementnumbers=dict( (symbol, z) for z, symbol in enumerate(elementsymbols) )
+elementnumbers['D']=1   # deuterium
+elementnumbers['T']=1   # tritium
+
+
+
+def elementcode(labels):
+    #
+    # Element codes (atomic numbers, int8) of an array of
+    # atom labels. Labels are matched by their leading 
+    # letters, so that e.g. 'OW', 'HW1', 'Na+' or 'Cl1' 
+    # give the codes of O, H, Na and Cl. Unknown labels
+    # get code 0. Each distinct label is looked up once.
+    #
+    unique, inverse = np.unique(np.asarray(labels), return_inverse=True)
+
+    codes=np.zeros(len(unique), dtype=np.int8)
+    for ilab, label in enumerate(unique):
+        letters=str(label).strip()
+        nletters=0
+        while (nletters < len(letters) and letters[nletters].isalpha()):
+            nletters+=1
+        letters=letters[0:nletters]
+
+        if letters in elementnumbers:
+            codes[ilab]=elementnumbers[letters]
+        elif (len(letters) > 0 and letters[0].upper() in elementnumbers):
+            codes[ilab]=elementnumbers[letters[0].upper()]
+
+    return codes[inverse]
+
+
+
+
+
 def file_len(fname):
     # From http://stackoverflow.com/questions/845058/how-to-get-line-count-cheaply-in-python
     # Count number of lines in file
@@ -1604,31 +1997,28 @@ def readANI(filename):
     # a list with all comment lines and a 
     # list of lists with all atomic positions.
     #
-    # 
+    # The whole file is kept in memory. For long
+    # trajectories use iter_frames() instead.
+    #
                                     
     nat=[]
     comment=[]
     txyz=[]
 
-
-    numlines=file_len(filename)
     
-    
-    # Open file and read contents
+    # Open file and read contents in a single pass
     
     f=open(filename, 'r')
     
     txyzaux=[]
     j=1 # j takes values from 1 to 2+nat for each cluster
-    ilin=1
-    while ilin <= numlines:
+    for row in f:
 
         # j is an auxiliary index that helps keeping track
         # of what kind of read should be done.
         # j==1     : read number of atoms
         # j==2     : read comment line
         # 2<j<=nat : read atom type and coordinates
-        row=f.readline()
         if (j==1):
             currentnat=int(row)
             nat.append(currentnat)
@@ -1647,49 +2037,1820 @@ def readANI(filename):
                 j=1
             else:
                 j=j+1
-            
-        ilin = ilin + 1
-
 
-        nsnap=len(nat)
+    f.close()
 
     return nat, comment, txyz
 
 
 
-def d(x1, x2):
+def readframe(f, iframe=0):
     #
-    # Cartesian distance between points x1 and x2.
+    # Read the frame starting at the current position
+    # of the open file f. Returns None at end of file.
+    # iframe is only used in error messages.
+    #
+    # Returns a tuple
+    #   nat     : number of atoms (int)
+    #   comment : comment line (string)
+    #   element : numpy array of atom labels (STRING)
+    #   x       : (nat,3) numpy array of cartesian coordinates (FLOAT)
     #
-    return math.sqrt( (x1[0]-x2[0])**2 + (x1[1]-x2[1])**2 + (x1[2]-x2[2])**2 )
 
+    row=f.readline()
+    while row and not row.strip():
+        row=f.readline()         # blank lines between or after frames
+    if not row:
+        return None              # end of file
 
+    nat=int(row)
+    comment=f.readline()
 
-def d_PBC(A, Ainv, x1, x2):
+    block=[f.readline() for iat in range(0, nat)]
+    element, x = parseblock(block, iframe)
+
+    return nat, comment, element, x
+
+
+
+def parseblock(block, iframe=0):
     #
-    # Cartesian distance between 2 points
-    # in a system with periodic boundary
-    # conditions (PBC)
+    # Convert the atom lines of one frame, a list of 
+    # strings "type x y z", into an array of atom labels
+    # and a (nat,3) FLOAT array. The whole block is split
+    # at once and converted with a single numpy call, 
+    # instead of splitting and calling float() per line.
+    # Any amount of whitespace between columns is fine.
+    # iframe is only used in error messages.
     #
-    # x1, x2: numpy arrays containing cartesian coordinates
-    # A: numpy matrix containing cell vectors
-    # Ainv: inverse of A
+    nat=len(block)
+    tokens=''.join(block).split()
+
+    if (len(tokens) != 4*nat):
+        # Some lines have extra columns (e.g. velocities
+        # or charges) or are incomplete. Go line by line
+        # and keep the first four columns.
+        rows=[row.split()[0:4] for row in block]
+        if (min([len(row) for row in rows] + [4]) < 4):
+            print "ERROR: frame ", iframe, " is truncated or malformed. EXIT"
+            exit()
+        tokens=[value for row in rows for value in row]
+
+    element=np.array(tokens[0::4])
+    del tokens[0::4]
+
+    try:
+        x=np.array(tokens, dtype=np.float64).reshape(nat,3)
+    except ValueError:
+        print "ERROR: frame ", iframe, " has non-numeric coordinates. EXIT"
+        exit()
+
+    return element, x
+
+
+
+def iter_frames(filename, start=None, stop=None, step=None):
     #
-    # Steps:
+    # Iterate over the frames of an ANI (or XYZ) file
+    # one at a time. Only the current frame is held in
+    # memory, so trajectories of any length can be
+    # processed in constant memory.
     #
-    # 1) calculate vector linking x1 and x2, r12
-    # 2) change to cell basis
-    # 3) translate to mimimum image
-    # 4) change to cartesian basis
-    # 5) calculate euclidean distance
-    # 
-    
-    r12=x1-x2
-    s12=np.dot(Ainv, r12)
-    s12[:]=s12[:] - np.round(s12[:])
-    r12=np.dot(A,s12)
-    return np.sqrt( np.dot(r12,r12) )
+    # start, stop, step select frames as in a python
+    # slice, e.g. iter_frames(filename, 1000, None, 10).
+    # When any of them is given the frame index of
+    # indexANI() is used to seek straight to the selected
+    # frames, so the skipped ones are not parsed.
+    #
+    # Yields, for each frame, a tuple
+    #   nat     : number of atoms (int)
+    #   comment : comment line (string)
+    #   element : numpy array of atom labels (STRING)
+    #   x       : (nat,3) numpy array of cartesian coordinates (FLOAT)
+    #
+    # Usage:
+    #   for nat, comment, element, x in iter_frames(filename):
+    #       ...
+    #
+
+    if (start is None and stop is None and step is None):
+
+        # Plain sequential read
+        with openANI(filename) as f:
+            iframe=0
+            frame=readframe(f, iframe)
+            while frame is not None:
+                yield frame
+                iframe+=1
+                frame=readframe(f, iframe)
+
+    else:
+
+        offsets, nat = indexANI(filename)
+        iframes=range(*slice(start, stop, step).indices(len(offsets)))
+
+        with openANI(filename) as f:
+            previous=None
+            for iframe in iframes:
+                # Frames read back to back need no seek
+                if (previous is None or iframe != previous+1):
+                    f.seek(offsets[iframe])
+                yield readframe(f, iframe)
+                previous=iframe
+
+    return
+
+
+
+def getframe(filename, iframe):
+    #
+    # Random access to frame iframe of an ANI (or XYZ)
+    # file through the frame index. Negative values
+    # count from the end as in python lists.
+    #
+    offsets, nat = indexANI(filename)
+
+    if (iframe < -len(offsets) or iframe >= len(offsets)):
+        print "ERROR: frame ", iframe, " out of range in ", filename, ". EXIT"
+        exit()
+
+    f=openANI(filename)
+    f.seek(offsets[iframe])
+    frame=readframe(f, iframe)
+    f.close()
+
+    return frame
+
+
+
+def indexANI(filename, rebuild=False):
+    #
+    # Byte offset of every frame header in an ANI (or
+    # XYZ) file. The index is built with a single scan
+    # that does not parse coordinates and is saved next
+    # to the trajectory as filename.idx. Later calls
+    # reuse it as long as the size and modification 
+    # time of the trajectory are unchanged.
+    #
+    # For compressed files the offsets refer to the
+    # decompressed text, and the index also stores the
+    # compressed blocks found during the scan, which
+    # openANI() uses as checkpoints for seeking.
+    #
+    # Returns
+    #   offsets : numpy array of byte offsets (int64)
+    #   nat     : numpy array with number of atoms per frame
+    #
+    if not rebuild:
+        saved=loadindex(filename)
+        if saved is not None:
+            return saved['offsets'], saved['nat']
+
+
+    # Scan headers, skipping the nat+1 lines after each of them
+    offsets=[]
+    nat=[]
+
+    f=openANI(filename)
+    while True:
+        pos=f.tell()
+        row=f.readline()
+        if not row:
+            break
+        if not row.strip():
+            continue
+
+        currentnat=int(row)
+        complete=True
+        for ilin in range(0, currentnat+1):
+            if not f.readline():
+                complete=False
+                break
+
+        if complete:
+            offsets.append(pos)
+            nat.append(currentnat)
+        else:
+            print "WARNING: last frame of ", filename, " is truncated and was not indexed."
+
+    if isinstance(f.raw, cstream):
+        checkpoints=np.array(f.raw.checkpoints, dtype=np.int64)
+    else:
+        checkpoints=np.zeros([0,2], dtype=np.int64)
+    f.close()
+
+    offsets=np.array(offsets, dtype=np.int64)
+    nat=np.array(nat, dtype=np.int64)
+
+    saveindex(filename, offsets, nat, checkpoints)
+
+    return offsets, nat
+
+
+
+def loadindex(filename):
+    #
+    # Saved frame index of filename (see indexANI) as 
+    # a dictionary, or None if missing or out of date.
+    #
+    idxname=filename+'.idx'
+    if not os.path.isfile(idxname):
+        return None
+
+    stat=os.stat(filename)
+    try:
+        saved=np.load(idxname)
+        if (int(saved['size']) == stat.st_size and float(saved['mtime']) == stat.st_mtime):
+            return dict( (key, saved[key]) for key in saved.files )
+    except (IOError, ValueError, KeyError):
+        pass  # unreadable index. It will be rebuilt
+
+    return None
+
+
+
+def saveindex(filename, offsets, nat, checkpoints):
+    #
+    # Write the frame index of filename to filename.idx.
+    # A read-only directory is not an error: the index
+    # is just rebuilt next time.
+    #
+    idxname=filename+'.idx'
+    stat=os.stat(filename)
+
+    try:
+        fidx=open(idxname, 'wb')
+        np.savez(fidx, offsets=offsets, nat=nat, checkpoints=checkpoints,
+                 size=stat.st_size, mtime=stat.st_mtime)
+        fidx.close()
+    except IOError:
+        print "WARNING: could not write frame index ", idxname
+
+    return
+
+
+
+def compression(filename):
+    #
+    # Detect the compression of a file from its first
+    # bytes. Returns 'gz', 'bz2', 'xz' or None.
+    #
+    f=open(filename, 'rb')
+    magic=f.read(6)
+    f.close()
+
+    if magic.startswith(b'\x1f\x8b'):
+        return 'gz'
+    elif magic.startswith(b'BZh'):
+        return 'bz2'
+    elif magic.startswith(b'\xfd7zXZ\x00'):
+        return 'xz'
+    else:
+        return None
+
+
+
+def openANI(filename):
+    #
+    # Open an ANI (or XYZ) file for reading in binary mode,
+    # decompressing .gz, .bz2 and .xz files on the fly.
+    # Compression is detected from the file contents, not 
+    # the name. Compressed files are read as a stream, with
+    # no temporary file, and tell()/seek() work in offsets
+    # of the decompressed text. 
+    #
+    # Seeking in a compressed file decompresses forward from
+    # the closest checkpoint before the target. Checkpoints
+    # are the starts of the independent blocks (gzip members,
+    # bz2 or xz streams) of the file, taken from its frame
+    # index if there is one. Files written by compressANI()
+    # have one block every few frames, so seeking is cheap.
+    #
+    kind=compression(filename)
+
+    if kind is None:
+        return io.open(filename, 'rb')
+
+    if (kind == 'xz' and lzma is None):
+        print "ERROR: reading ", filename, " needs the lzma module. EXIT"
+        exit()
+
+    saved=loadindex(filename)
+    if saved is not None and 'checkpoints' in saved:
+        checkpoints=saved['checkpoints']
+    else:
+        checkpoints=None
+
+    return io.BufferedReader(cstream(filename, kind, checkpoints), 1<<16)
+
+
+
+class cstream(io.RawIOBase):
+    #
+    # Raw, read-only and seekable stream of the decompressed
+    # contents of a compressed file made of one or more
+    # concatenated blocks (gzip members, bz2 or xz streams).
+    # Use it through openANI().
+    #
+    # checkpoints is a list of (compressed offset, 
+    # decompressed offset) pairs, one per block start. It is
+    # extended as new blocks are found while reading.
+    #
+    chunksize=1<<16
+
+    def __init__(self, filename, kind, checkpoints=None):
+        io.RawIOBase.__init__(self)
+
+        self.kind=kind
+        self.fcomp=open(filename, 'rb')
+
+        self.checkpoints=[(0, 0)]
+        if checkpoints is not None:
+            self.checkpoints=sorted(set( [(0, 0)] + [ (int(c), int(u)) for c, u in checkpoints ] ))
+
+        self.restart(0, 0)
+
+
+
+    def newdecompressor(self):
+        if (self.kind == 'gz'):
+            return zlib.decompressobj(16+zlib.MAX_WBITS)
+        elif (self.kind == 'bz2'):
+            return bz2.BZ2Decompressor()
+        else:
+            return lzma.LZMADecompressor()
+
+
+
+    def restart(self, craw, upos):
+        #
+        # Start decompressing the block at compressed
+        # offset craw, decompressed offset upos
+        #
+        self.fcomp.seek(craw)
+        self.rawpos=craw
+        self.pos=upos
+        self.dec=self.newdecompressor()
+        self.buf=b''
+        self.bufpos=0
+        self.eof=False
+
+
+
+    def fill(self):
+        #
+        # Decompress the next chunk into self.buf. Returns
+        # False at end of file.
+        #
+        while (self.bufpos >= len(self.buf)):
+
+            if self.eof:
+                return False
+
+            chunk=self.fcomp.read(self.chunksize)
+            if not chunk:
+                self.eof=True
+                return False
+            start=self.rawpos
+            self.rawpos+=len(chunk)
+
+            try:
+                data=self.dec.decompress(chunk)
+            except EOFError:
+                # Previous block ended exactly at the end
+                # of the previous chunk (bz2, xz)
+                self.addcheckpoint(start, self.pos)
+                self.dec=self.newdecompressor()
+                data=self.dec.decompress(chunk)
+
+            # Decompressor reached the end of a block. The rest
+            # of the chunk is the beginning of the next one.
+            unused=self.dec.unused_data
+            while unused:
+                if not unused.strip(b'\x00'):
+                    self.eof=True        # zero padding at end of file
+                    break
+                craw=start+len(chunk)-len(unused)
+                self.addcheckpoint(craw, self.pos+len(data))
+                self.dec=self.newdecompressor()
+                data+=self.dec.decompress(unused)
+                chunk=unused
+                start=craw
+                unused=self.dec.unused_data
+
+            self.buf=data
+            self.bufpos=0
+
+        return True
+
+
+
+    def addcheckpoint(self, craw, upos):
+        if (craw > self.checkpoints[-1][0]):
+            self.checkpoints.append((craw, upos))
+        return
+
+
+
+    def readinto(self, b):
+        if not self.fill():
+            return 0
+
+        n=min(len(b), len(self.buf)-self.bufpos)
+        b[0:n]=self.buf[self.bufpos:self.bufpos+n]
+        self.bufpos+=n
+        self.pos+=n
+
+        return n
+
+
+
+    def readable(self):
+        return True
+
+
+
+    def seekable(self):
+        return True
+
+
+
+    def tell(self):
+        return self.pos
+
+
+
+    def seek(self, offset, whence=0):
+
+        if (whence == 1):
+            if (offset == 0):
+                return self.pos
+            offset=self.pos+offset
+        elif (whence == 2):
+            print "ERROR: seek from the end of a compressed file is not supported. EXIT"
+            exit()
+
+        # Jump to the closest block start before offset unless
+        # the target is ahead of us in the current block
+        icheck=np.searchsorted([u for c, u in self.checkpoints], offset, side='right')-1
+        craw, upos = self.checkpoints[icheck]
+        if (offset < self.pos or upos > self.pos):
+            self.restart(craw, upos)
+
+        # Decompress forward up to offset
+        while (self.pos < offset):
+            if not self.fill():
+                break
+            n=min(offset-self.pos, len(self.buf)-self.bufpos)
+            self.bufpos+=n
+            self.pos+=n
+
+        return self.pos
+
+
+
+    def close(self):
+        self.fcomp.close()
+        io.RawIOBase.close(self)
+
+
+
+def compressANI(filename, outname=None, kind='gz', framesperblock=100):
+    #
+    # Compress an ANI (or XYZ) file as a series of independent
+    # blocks of framesperblock frames each (gzip members, bz2 
+    # or xz streams). The result is a normal compressed file
+    # for gunzip, bunzip2 or unxz, but openANI() can start
+    # decompressing at any block, so reading frame 90000 only
+    # decompresses the block that contains it. The frame index
+    # of the compressed file is written as well.
+    #
+    # Returns the name of the compressed file.
+    #
+    if (kind not in ['gz', 'bz2', 'xz']):
+        print "ERROR: unrecognized compression ", kind, ". EXIT"
+        exit()
+    if (kind == 'xz' and lzma is None):
+        print "ERROR: writing .xz files needs the lzma module. EXIT"
+        exit()
+
+    if outname is None:
+        outname=filename+'.'+kind
+
+    offsets, nat = indexANI(filename)
+    bounds=list(offsets[::framesperblock]) + [os.path.getsize(filename)]
+    if compression(filename) is not None:
+        bounds[-1]=None   # decompressed size unknown. Read to the end
+
+    fin=openANI(filename)
+    fout=open(outname, 'wb')
+
+    checkpoints=[]
+    for iblock in range(0, len(bounds)-1):
+
+        fin.seek(bounds[iblock])
+        if bounds[iblock+1] is None:
+            data=fin.read()
+        else:
+            data=fin.read(bounds[iblock+1]-bounds[iblock])
+
+        checkpoints.append((fout.tell(), bounds[iblock]))
+
+        if (kind == 'gz'):
+            comp=zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+            fout.write(comp.compress(data) + comp.flush())
+        elif (kind == 'bz2'):
+            fout.write(bz2.compress(data))
+        else:
+            fout.write(lzma.compress(data))
+
+    fin.close()
+    fout.close()
+
+    # Decompressed contents are unchanged, so the frame
+    # offsets are those of the input file
+    saveindex(outname, offsets, nat, np.array(checkpoints, dtype=np.int64).reshape(-1,2))
+
+    return outname
+
+
+
+def chunkframes(filename, nchunks):
+    #
+    # Split the frames of an ANI (or XYZ) file into
+    # nchunks contiguous ranges of (almost) equal length,
+    # e.g. one per parallel worker. Returns a list of
+    # (start, stop) pairs to be passed to iter_frames():
+    #
+    #   for start, stop in chunkframes(filename, nworkers):
+    #       ... iter_frames(filename, start, stop) ...
+    #
+    offsets, nat = indexANI(filename)
+
+    if (nchunks < 1):
+        print "ERROR: number of chunks must be larger than 0. EXIT"
+        exit()
+
+    bounds=np.linspace(0, len(offsets), nchunks+1).round().astype(int)
+
+    return [ (bounds[i], bounds[i+1]) for i in range(0, nchunks) ]
+
+
+
+class prefetch(object):
+    #
+    # Read frames ahead in a background thread, so that
+    # reading and parsing the next frames overlaps with the
+    # analysis of the current one. Wraps any frame source
+    # (iter_frames, a trajectory, a list...) and yields the
+    # same frames in the same order:
+    #
+    #   for nat, comment, element, x in h2o.prefetch(h2o.iter_frames(filename)):
+    #       ...
+    #
+    # depth : number of frames kept ready. The reader blocks
+    #         when the queue is full, so memory use is bounded
+    #         by depth+1 frames.
+    # func  : optional function applied to every frame in the
+    #         background thread, e.g. to build snapshots there.
+    #         The loop then receives func(frame).
+    #
+    # Disk reads and decompression release the GIL and run
+    # fully in parallel with the analysis. Parsing in the 
+    # thread overlaps with the numpy parts of the analysis.
+    #
+    def __init__(self, frames, depth=4, func=None):
+
+        if (depth < 1):
+            print "ERROR: prefetch depth must be larger than 0. EXIT"
+            exit()
+
+        self.depth=depth
+        self.func=func
+        self.queue=queue.Queue(maxsize=depth)
+        self.stopped=threading.Event()
+        self.done=object()     # end of frames marker
+
+        self.thread=threading.Thread(target=self.produce, args=(frames,))
+        self.thread.daemon=True
+        self.thread.start()
+
+
+
+    def produce(self, frames):
+        #
+        # Background thread. Errors, including exit() calls of
+        # the readers, are passed to the loop and raised there.
+        #
+        try:
+            for frame in frames:
+                if self.func is not None:
+                    frame=self.func(frame)
+                if not self.put((frame, None)):
+                    return
+        except BaseException:
+            self.put((None, sys.exc_info()))
+            return
+
+        self.put((self.done, None))
+
+        return
+
+
+
+    def put(self, item):
+        # Wait for room in the queue unless the loop was stopped
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+
+    def __iter__(self):
+
+        try:
+            while True:
+                frame, error = self.queue.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if frame is self.done:
+                    break
+                yield frame
+        finally:
+            self.close()
+
+        return
+
+
+
+    def close(self):
+        #
+        # Stop the background thread, e.g. after leaving
+        # the loop early.
+        #
+        self.stopped.set()
+        self.thread.join()
+
+        return
+
+
+
+# Version of the cache written by cacheANI. Older caches
+# are rebuilt
+CACHEVERSION=3
+
+
+
+def cacheANI(filename, A=None, cachedir=None, rebuild=False):
+    #
+    # Convert an ANI (or XYZ) file once into a binary cache
+    # that can be memory mapped, and return it opened as a
+    # trajectory object. The cache is a directory (by default
+    # filename.cache) of .npy files:
+    #
+    #   x.npy        : (nframes,nat,3) FLOAT coordinates
+    #   labelindx.npy: (nat,) index of the label of each atom
+    #                  in elements.npy (not an atomic number)
+    #   elements.npy : element labels (STRING)
+    #   comment.npy  : (nframes,) comment lines (STRING), as
+    #                  returned by readframe (with their newline)
+    #   cell.npy     : (nframes,3,3) cell matrices. Only if A is given,
+    #                  either a single 3x3 matrix or one per frame
+    #   source.npy   : size and modification time of filename,
+    #                  and version of the cache format
+    #
+    # The cache is rebuilt if the ANI file changes. All frames
+    # must have the same atoms in the same order.
+    #
+    if cachedir is None:
+        cachedir=filename+'.cache'
+
+    stat=os.stat(filename)
+
+    if (not rebuild and iscurrent(cachedir, stat)):
+        return trajectory(cachedir)
+
+
+    offsets, nat = indexANI(filename)
+    nframes=len(offsets)
+    if (nframes < 1 or np.any(nat != nat[0])):
+        print "ERROR: ", filename, " must contain frames with a constant number of atoms. EXIT"
+        exit()
+
+
+    # Write into a temporary directory and rename it at the
+    # end, so that other processes never see a partial cache.
+    tmpdir=cachedir+'.tmp'+str(os.getpid())
+    os.mkdir(tmpdir)
+
+    x=np.lib.format.open_memmap(os.path.join(tmpdir, 'x.npy'), mode='w+',
+                                dtype=np.float64, shape=(nframes, nat[0], 3))
+    comment=[]
+    for iframe, frame in enumerate(iter_frames(filename)):
+        if (iframe == 0):
+            element=frame[2]
+            elements, labelindx = np.unique(element, return_inverse=True)
+        elif not np.array_equal(frame[2], element):
+            print "ERROR: atoms in frame ", iframe, " of ", filename, " differ from frame 0. EXIT"
+            exit()
+        comment.append(frame[1])
+        x[iframe]=frame[3]
+    x.flush()
+    del x
+
+    np.save(os.path.join(tmpdir, 'labelindx.npy'), labelindx.astype(np.int16))
+    np.save(os.path.join(tmpdir, 'elements.npy'), elements)
+    np.save(os.path.join(tmpdir, 'comment.npy'), np.array(comment))
+
+    if A is not None:
+        A=np.array(A, dtype=np.float64)
+        if (A.shape == (3,3)):
+            A=np.tile(A, (nframes, 1, 1))
+        if (A.shape != (nframes, 3, 3)):
+            print "ERROR: A must be a 3x3 matrix or one 3x3 matrix per frame. EXIT"
+            exit()
+        np.save(os.path.join(tmpdir, 'cell.npy'), A)
+
+    np.save(os.path.join(tmpdir, 'source.npy'), np.array([stat.st_size, stat.st_mtime, CACHEVERSION]))
+
+
+    # Move the cache in place. Renaming fails if cachedir
+    # exists: either another process building the same
+    # cache got there first, then use its cache and drop
+    # ours, or it is an old cache, moved aside (renames are
+    # atomic) and removed
+    try:
+        os.rename(tmpdir, cachedir)
+    except OSError:
+        if (rebuild or not iscurrent(cachedir, stat)):
+            olddir=cachedir+'.old'+str(os.getpid())
+            try:
+                os.rename(cachedir, olddir)
+                os.rename(tmpdir, cachedir)
+            except OSError:
+                pass   # another process replaced it meanwhile
+            removecache(olddir)
+        removecache(tmpdir)
+
+    return trajectory(cachedir)
+
+
+
+def iscurrent(cachedir, stat):
+    #
+    # True if cachedir is a complete cache of the file
+    # with os.stat() stat, written by this version of
+    # cacheANI
+    #
+    try:
+        source=np.load(os.path.join(cachedir, 'source.npy'))
+    except (IOError, ValueError):
+        return False  # no cache or incomplete cache
+
+    return (len(source) == 3 and int(source[0]) == stat.st_size and source[1] == stat.st_mtime
+            and source[2] == CACHEVERSION)
+
+
+
+def removecache(cachedir):
+    #
+    # Remove the cache directory cachedir, if it exists
+    #
+    if not os.path.isdir(cachedir):
+        return
+
+    for name in os.listdir(cachedir):
+        os.remove(os.path.join(cachedir, name))
+    os.rmdir(cachedir)
+
+
+
+class trajectory(object):
+    #
+    # Read-only view of a binary trajectory cache written
+    # by cacheANI(). Coordinates are memory mapped, so
+    # opening is independent of the trajectory length and
+    # concurrent processes share the page cache. Frames 
+    # are returned as zero-copy views in the same format
+    # as iter_frames():
+    #
+    #   traj=h2o.cacheANI(filename, A)
+    #   for nat, comment, element, x in traj:
+    #       ...
+    #   nat, comment, element, x = traj[90000]
+    #
+    def __init__(self, cachedir):
+
+        if not os.path.isfile(os.path.join(cachedir, 'x.npy')):
+            print "ERROR: ", cachedir, " is not a trajectory cache. EXIT"
+            exit()
+
+        self.x=np.load(os.path.join(cachedir, 'x.npy'), mmap_mode='r')
+        self.nframes=self.x.shape[0]
+        self.nat=self.x.shape[1]
+
+        self.elements=np.load(os.path.join(cachedir, 'elements.npy'))
+        self.labelindx=np.load(os.path.join(cachedir, 'labelindx.npy'))
+        self.element=self.elements[self.labelindx]
+
+        self.comment=np.load(os.path.join(cachedir, 'comment.npy'), mmap_mode='r')
+
+        # Cell matrices, None if they were not provided
+        if os.path.isfile(os.path.join(cachedir, 'cell.npy')):
+            self.A=np.load(os.path.join(cachedir, 'cell.npy'), mmap_mode='r')
+        else:
+            self.A=None
+
+
+
+    def __len__(self):
+        return self.nframes
+
+
+
+    def __getitem__(self, iframe):
+        return self.frame(iframe)
+
+
+
+    def __iter__(self):
+        for iframe in range(0, self.nframes):
+            yield self.frame(iframe)
+
+
+
+    def frame(self, iframe):
+        #
+        # Frame iframe as (nat, comment, element, x). 
+        # x is a read-only view into the memory map.
+        #
+        if (iframe < -self.nframes or iframe >= self.nframes):
+            print "ERROR: frame ", iframe, " out of range. EXIT"
+            exit()
+
+        return self.nat, str(self.comment[iframe]), self.element, self.x[iframe]
+
+
+
+    def cell(self, iframe):
+        #
+        # Cell matrix of frame iframe, or None if unknown
+        #
+        if self.A is None:
+            return None
+
+        return self.A[iframe]
+
+
+
+def d(x1, x2):
+    #
+    # Cartesian distance between points x1 and x2.
+    #
+    return math.sqrt( (x1[0]-x2[0])**2 + (x1[1]-x2[1])**2 + (x1[2]-x2[2])**2 )
+
+
+
+def d_PBC(A, Ainv, x1, x2):
+    #
+    # Cartesian distance between 2 points
+    # in a system with periodic boundary
+    # conditions (PBC)
+    #
+    # x1, x2: numpy arrays containing cartesian coordinates
+    # A: numpy matrix containing cell vectors, or a cell
+    #    object (then Ainv is not used)
+    # Ainv: inverse of A
+    #
+    # Steps:
+    #
+    # 1) calculate vector linking x1 and x2, r12
+    # 2) change to cell basis
+    # 3) translate to mimimum image
+    # 4) change to cartesian basis
+    # 5) calculate euclidean distance
+    # 
+    
+    if isinstance(A, cell):
+        r12=A.mic(x1-x2)
+        return np.sqrt( np.dot(r12,r12) )
+
+    r12=x1-x2
+    s12=np.dot(Ainv, r12)
+    s12[:]=s12[:] - np.round(s12[:])
+    r12=np.dot(A,s12)
+    return np.sqrt( np.dot(r12,r12) )
+
+
+
+
+def pbcdistances(c, x, y=None, tile=None, dtype=np.float64, condensed=False):
+    #
+    # Minimum image distances between all rows of x and
+    # all rows of y (or of x itself if y is None) in the
+    # cell c. Broadcast over tiles of rows of x, so that
+    # temporary memory stays bounded for any size.
+    #
+    #  - c: cell object
+    #  - x, y: (n,3) and (m,3) arrays of cartesian coordinates
+    #  - tile: number of rows of x per tile. If None, chosen
+    #          so that each tile holds about 2^18 pairs
+    #  - dtype: type of the returned distances, e.g. np.float32.
+    #           Distances are always computed in FLOAT64
+    #  - condensed: only if y is None. Return the upper 
+    #           triangle (i<j) row by row as a 1d array of 
+    #           length n*(n-1)/2, as in scipy's pdist
+    #
+    # Returns the (n,m) matrix of distances, or the condensed
+    # array.
+    #
+    x=np.asarray(x, dtype=np.float64)
+    if y is None:
+        y=x
+        same=True
+    else:
+        y=np.asarray(y, dtype=np.float64)
+        same=False
+        if condensed:
+            print "ERROR: condensed distances need y=None. EXIT"
+            exit()
+
+    n=len(x)
+    m=len(y)
+
+    if tile is None:
+        tile=max(1, (1<<18)//max(m,1))
+
+    # Triclinic cells work with fractional coordinates
+    # computed once, so each pair needs a single product 
+    # with A. Orthorhombic cells need no products at all.
+    if c.ortho:
+        xs=x
+        ys=y
+        image=c.mic
+    else:
+        xs=c.frac(x)
+        ys=xs if same else c.frac(y)
+        image=c.micfrac
+
+    if condensed:
+        D=np.zeros((n*(n-1))//2, dtype=dtype)
+    else:
+        D=np.zeros([n,m], dtype=dtype)
+
+    for i0 in range(0, n, tile):
+        i1=min(i0+tile, n)
+
+        if condensed:
+            # Only columns j>i0 are needed for this tile
+            r=image(xs[i0:i1,np.newaxis,:] - ys[np.newaxis,i0+1:,:])
+            r=np.sqrt(np.sum(r*r, axis=-1))
+            for i in range(i0, i1):
+                start=n*i - (i*(i+1))//2
+                D[start:start+n-i-1]=r[i-i0, i-i0:]
+        else:
+            r=image(xs[i0:i1,np.newaxis,:] - ys[np.newaxis,:,:])
+            D[i0:i1]=np.sqrt(np.sum(r*r, axis=-1))
+
+    if (same and not condensed):
+        D[np.arange(n), np.arange(n)]=0.0
+
+    return D
+
+
+
+def neighborpairs(c, x, rcut, y=None):
+    #
+    # All pairs of points within distance rcut (minimum
+    # image) in the cell c, found with a linked-cell search
+    # in O(N) instead of checking all pairs.
+    #
+    #  - c: cell object. Any (triclinic) cell is fine
+    #  - x: (n,3) array of cartesian coordinates
+    #  - rcut: cutoff distance
+    #  - y: optional (m,3) array. If given, pairs are
+    #       between x and y. If None, pairs i<j within x
+    #
+    # The cell is divided in bins along the three cell
+    # vectors, each at least rcut thick, so all neighbors
+    # of a point are in its own bin or the 26 around it.
+    # Candidate pairs for all points and each of the 27
+    # bin offsets are generated at once with numpy.
+    # Small cells with fewer than 3 bins along some
+    # direction use the tiled all-pairs kernel instead.
+    #
+    # Returns, sorted by i and then j,
+    #   i, j : index arrays of each pair (into x, and into
+    #          y if given)
+    #   r    : (npair,3) minimum image vectors from x[i]
+    #          to x[j] (or y[j])
+    #   d    : distances |r|
+    #
+    x=np.asarray(x, dtype=np.float64)
+    same=y is None
+    if same:
+        y=x
+    else:
+        y=np.asarray(y, dtype=np.float64)
+
+    n=len(x)
+    m=len(y)
+
+    # Number of bins along each cell vector. The thickness
+    # of the cell along a_k is 1/|row k of Ainv|
+    thickness=1.0/np.sqrt(np.sum(c.Ainv*c.Ainv, axis=1))
+    nbin=np.floor(thickness/rcut).astype(np.int64)
+
+    if (np.any(nbin < 3) or n == 0 or m == 0):
+        return neighborpairs_allpairs(c, x, rcut, y, same)
+
+
+    # Bin of every point, from fractional coordinates
+    # wrapped into [0,1)
+    sx=c.frac(x)
+    sx=sx - np.floor(sx)
+    bx=np.minimum((sx*nbin).astype(np.int64), nbin-1)
+    if same:
+        sy=sx
+        by=bx
+    else:
+        sy=c.frac(y)
+        sy=sy - np.floor(sy)
+        by=np.minimum((sy*nbin).astype(np.int64), nbin-1)
+
+    flaty=(by[:,0]*nbin[1] + by[:,1])*nbin[2] + by[:,2]
+
+
+    # Points of y sorted by bin, with start and count per bin
+    order=np.argsort(flaty, kind='mergesort')
+    counts=np.bincount(flaty, minlength=nbin.prod())
+    starts=np.cumsum(counts) - counts
+
+
+    ipairs=[]
+    jpairs=[]
+    for ox in (-1, 0, 1):
+        for oy in (-1, 0, 1):
+            for oz in (-1, 0, 1):
+
+                # Neighbor bin of every point of x for this offset
+                nb=( ((bx[:,0]+ox) % nbin[0])*nbin[1] + (bx[:,1]+oy) % nbin[1] )*nbin[2] + (bx[:,2]+oz) % nbin[2]
+                cnt=counts[nb]
+                total=cnt.sum()
+                if (total == 0):
+                    continue
+
+                # All (point, member of neighbor bin) combinations
+                ii=np.repeat(np.arange(n), cnt)
+                first=np.cumsum(cnt) - cnt
+                jj=order[ np.repeat(starts[nb] - first, cnt) + np.arange(total) ]
+
+                if same:
+                    keep= ii < jj
+                    ii=ii[keep]
+                    jj=jj[keep]
+
+                ipairs.append(ii)
+                jpairs.append(jj)
+
+    if (len(ipairs) == 0):
+        ipairs=[np.zeros(0, dtype=np.int64)]
+        jpairs=[np.zeros(0, dtype=np.int64)]
+
+    return neighborpairs_select(c, sx, sy, np.concatenate(ipairs), np.concatenate(jpairs), rcut, frac=True)
+
+
+
+def neighborpairs_allpairs(c, x, rcut, y, same):
+    #
+    # neighborpairs() for cells too small for binning:
+    # check all pairs, one tile of rows at a time
+    #
+    n=len(x)
+    m=len(y)
+    tile=max(1, (1<<18)//max(m,1))
+
+    ipairs=[np.zeros(0, dtype=np.int64)]
+    jpairs=[np.zeros(0, dtype=np.int64)]
+    for i0 in range(0, n, tile):
+        i1=min(i0+tile, n)
+        D=pbcdistances(c, x[i0:i1], y)
+        ii, jj = np.nonzero(D <= rcut)
+        ii=ii+i0
+        if same:
+            keep= ii < jj
+            ii=ii[keep]
+            jj=jj[keep]
+        ipairs.append(ii)
+        jpairs.append(jj)
+
+    return neighborpairs_select(c, x, y, np.concatenate(ipairs), np.concatenate(jpairs), rcut)
+
+
+
+def neighborpairs_select(c, x, y, ii, jj, rcut, frac=False):
+    #
+    # Minimum image vectors and distances of candidate
+    # pairs (ii, jj). Keep those within rcut, sorted by
+    # ii and then jj. x, y are fractional if frac=True.
+    #
+    if frac:
+        r=c.micfrac(y[jj] - x[ii])
+    else:
+        r=c.mic(y[jj] - x[ii])
+    r=r.reshape(-1,3)
+    d=np.sqrt(np.sum(r*r, axis=1))
+
+    keep= d <= rcut
+    ii=ii[keep]
+    jj=jj[keep]
+    r=r[keep]
+    d=d[keep]
+
+    order=np.lexsort((jj, ii))
+
+    return ii[order], jj[order], r[order], d[order]
+
+
+
+class verletlist(object):
+    #
+    # Neighbor list with a skin that is kept across frames.
+    # Candidate pairs within rcut+skin are found with the
+    # linked-cell search of neighborpairs(), and only found
+    # again when some point has moved more than skin/2 since
+    # then (or the cell or the number of points changed).
+    # In all other frames the candidates are just filtered
+    # with the new coordinates. Between consecutive MD
+    # frames atoms move a small fraction of an Angstrom, so
+    # most frames only need the filtering step.
+    #
+    #   nlist=h2o.verletlist(3.5, skin=0.5)
+    #   for ... frames ...:
+    #       i, j, r, d = nlist.update(c, x)
+    #
+    #  - rcut: cutoff distance of the pairs returned
+    #  - skin: extra distance kept in the candidates. Larger
+    #          skins rebuild less often but filter more pairs
+    #
+    def __init__(self, rcut, skin=0.5):
+
+        if (rcut <= 0.0 or skin < 0.0):
+            print "ERROR: verletlist needs rcut > 0 and skin >= 0. EXIT"
+            exit()
+
+        self.rcut=rcut
+        self.skin=skin
+
+        # Coordinates and cell at the last build
+        self.xref=None
+        self.yref=None
+        self.A=None
+
+        # Candidate pairs
+        self.ci=np.zeros(0, dtype=np.int64)
+        self.cj=np.zeros(0, dtype=np.int64)
+
+        # Number of builds and of calls to update()
+        self.nbuild=0
+        self.nupdate=0
+
+
+
+    def maxdisplacement(self, c, x, xref):
+        #
+        # Largest minimum image displacement since last build
+        #
+        if (len(x) == 0):
+            return 0.0
+        dx=c.mic(x - xref)
+        return math.sqrt(np.max(np.sum(dx*dx, axis=1)))
+
+
+
+    def needsbuild(self, c, x, y):
+
+        if (self.xref is None or len(x) != len(self.xref)):
+            return True
+        if (y is None) != (self.yref is None):
+            return True
+        if (y is not None and len(y) != len(self.yref)):
+            return True
+        if not np.array_equal(c.A, self.A):
+            return True
+
+        moved=self.maxdisplacement(c, x, self.xref)
+        if y is not None:
+            moved=max(moved, self.maxdisplacement(c, y, self.yref))
+
+        return moved > 0.5*self.skin
+
+
+
+    def update(self, c, x, y=None):
+        #
+        # Pairs within rcut for the current coordinates, in 
+        # the same format as neighborpairs(c, x, rcut, y)
+        #
+        x=np.asarray(x, dtype=np.float64)
+        if y is not None:
+            y=np.asarray(y, dtype=np.float64)
+
+        self.nupdate+=1
+
+        if self.needsbuild(c, x, y):
+            self.ci, self.cj, r, d = neighborpairs(c, x, self.rcut+self.skin, y)
+            self.xref=x.copy()
+            self.yref=None if y is None else y.copy()
+            self.A=np.array(c.A)
+            self.nbuild+=1
+
+            keep= d <= self.rcut
+            return self.ci[keep], self.cj[keep], r[keep], d[keep]
+
+        if y is None:
+            y=x
+
+        return neighborpairs_select(c, x, y, self.ci, self.cj, self.rcut)
+
+
+
+class neighborshells(object):
+    #
+    # Sorted neighbor shells of all points at once: for
+    # every point, all other points within rmax (minimum
+    # image) sorted by distance, with their vectors. Built
+    # from a single neighbor search, and queried for the k
+    # nearest neighbors or the shell up to some radius. 
+    #
+    #  - c: cell object
+    #  - x: (n,3) array of cartesian coordinates
+    #  - rmax: radius of the shells
+    #  - kmin: every point must have at least kmin neighbors
+    #  - beyond: every point must have a neighbor at distance
+    #            >= beyond (e.g. the first one past a cutoff)
+    #  - nlist: optional verletlist for x. Its cutoff is rmax
+    #
+    # If kmin or beyond are not satisfied rmax is enlarged
+    # until they are. Past half the cell thickness all pairs
+    # are used, as a full distance matrix would.
+    #
+    # Shells are stored as flat arrays sorted by point and
+    # then by distance. The neighbors of point i are at
+    # positions start[i]:start[i+1] of
+    #   nbr : neighbor indices
+    #   d   : distances
+    #   r   : (.,3) minimum image vectors x[nbr]-x[i]
+    #
+    def __init__(self, c, x, rmax, kmin=0, beyond=None, nlist=None):
+
+        self.n=len(x)
+        self.kmin=kmin
+
+        thickness=1.0/np.sqrt(np.sum(c.Ainv*c.Ainv, axis=1))
+        rhalf=0.5*thickness.min()
+
+        while True:
+            if nlist is not None:
+                i, j, r, d = nlist.update(c, x)
+                rmax=nlist.rcut
+                nlist=None         # enlarged radius, if needed, is searched directly
+            elif (rmax >= rhalf):
+                rmax=np.inf
+                i, j, r, d = neighborpairs_allpairs(c, np.asarray(x, dtype=np.float64), np.inf,
+                                                    np.asarray(x, dtype=np.float64), True)
+            else:
+                i, j, r, d = neighborpairs(c, x, rmax)
+
+            self.build(i, j, r, d)
+            self.rmax=rmax
+
+            if (self.complete(kmin, beyond) or np.isinf(rmax)):
+                break
+            rmax=min(1.3*rmax, rhalf)
+
+
+
+    def build(self, i, j, r, d):
+        #
+        # Flat shells from pairs i<j, in both directions
+        #
+        center=np.concatenate((i, j))
+        self.nbr=np.concatenate((j, i))
+        self.d=np.concatenate((d, d))
+        self.r=np.concatenate((r, -r))
+
+        order=np.lexsort((self.d, center))
+        center=center[order]
+        self.nbr=self.nbr[order]
+        self.d=self.d[order]
+        self.r=self.r[order]
+
+        self.center=center
+        self.start=np.searchsorted(center, np.arange(self.n+1))
+        self.count=np.diff(self.start)
+
+        return
+
+
+
+    def complete(self, kmin, beyond):
+        #
+        # True if every shell has at least kmin neighbors
+        # and reaches distance beyond
+        #
+        if (self.n == 0):
+            return True
+        if (self.count.min() < max(kmin, 1 if beyond is not None else 0)):
+            return False
+        if beyond is not None:
+            last=self.d[self.start[1:]-1]
+            if (last.min() < beyond):
+                return False
+
+        return True
+
+
+
+    def knn(self, k):
+        #
+        # The k nearest neighbors of every point. Returns
+        # (n,k) arrays of indices and distances and the
+        # (n,k,3) array of vectors to them.
+        #
+        if (self.count.min() < k):
+            print "ERROR: some shell has less than ", k, " neighbors. EXIT"
+            exit()
+
+        pos=self.start[:-1,np.newaxis] + np.arange(k)
+
+        return self.nbr[pos], self.d[pos], self.r[pos]
+
+
+
+    def shell(self, i, rcut=None):
+        #
+        # Neighbors of point i within rcut (the whole shell
+        # if None): indices, distances and vectors
+        #
+        i0=self.start[i]
+        i1=self.start[i+1]
+        if rcut is not None:
+            i1=i0 + np.searchsorted(self.d[i0:i1], rcut, side='right')
+
+        return self.nbr[i0:i1], self.d[i0:i1], self.r[i0:i1]
+
+
+
+class topology(object):
+    #
+    # Molecule table (H2Oindx) of a trajectory, found once
+    # with FindH2Os in the first frame and kept for the 
+    # following ones. Molecules keep their index (the row 
+    # of their O in H2Oindx) in all frames.
+    #
+    # In every frame the distance of each H to its O is
+    # checked at once. Only Hs farther than rcheck from
+    # their O (and Hs without O) are searched again, and
+    # if their closest O changed (proton transfer) they are
+    # given to it and the event is reported. A molecule row
+    # is only rewritten when its O has two Hs again; in the
+    # meantime its O is listed in defects. An O without a
+    # row in the first frame (a defect then) gets a new row,
+    # at the end of the table, the first time it has two Hs.
+    #
+    # Hs that FindH2Os put in two molecules (Hshared) stay
+    # in both rows, and count as an H of both Os, until they
+    # move to a new O.
+    #
+    #   topo=None
+    #   for ... frames ...:
+    #       allmol=h2o.cluster.from_snapshot(snap, napm)
+    #       if topo is None:
+    #           topo=h2o.topology(allmol, cutoff=OOcutoff)
+    #       else:
+    #           events=topo.update(allmol)
+    #
+    #  - cl: cluster of the first frame
+    #  - cutoff: O-H cutoff for FindH2Os and for the search
+    #            of the new O of a flagged H
+    #  - rcheck: O-H distance beyond which an H is flagged
+    #
+    def __init__(self, cl, cutoff=3.0, rcheck=1.25):
+
+        self.cutoff=cutoff
+        self.rcheck=rcheck
+
+        if (len(cl.H2Oindx) == 0):
+            cl.FindH2Os(cl.A, cl.Ainv, cutoff=cutoff)
+
+        self.nat=cl.nat
+        self.ecode=cl.ecode.copy()
+        self.Oindx=cl.Oindx
+        self.Hindx=cl.Hindx
+        self.otherindx=cl.otherindx
+        self.H2Oindx=cl.H2Oindx.copy()
+
+        # Howner[iH] is the atom index of the O of atom iH, 
+        # or -1 if it has none (also for non-H atoms). For
+        # shared Hs, the O of the last row that has it
+        self.Howner=np.empty(self.nat, dtype=np.int32)
+        self.Howner.fill(-1)
+        self.Howner[self.H2Oindx[:,1]]=self.H2Oindx[:,0]
+        self.Howner[self.H2Oindx[:,2]]=self.H2Oindx[:,0]
+
+        # Row of each O in H2Oindx, -1 if not in the table
+        self.Orow=np.empty(self.nat, dtype=np.int32)
+        self.Orow.fill(-1)
+        self.Orow[self.H2Oindx[:,0]]=np.arange(len(self.H2Oindx))
+
+        self.Hshared=cl.Hshared.astype(np.int32)
+        self.defects=cl.Odefects
+        self.reassign([])
+
+        # Frame counter and all proton transfer events as
+        # rows of [frame, H, old O, new O]
+        self.iframe=0
+        self.events=np.zeros((0,4), dtype=np.int64)
+
+        self.apply(cl)
+
+
+
+    def update(self, cl):
+        #
+        # Check the topology against the coordinates of the 
+        # cluster cl of the next frame, reassign flagged Hs
+        # and set the index arrays of cl. Returns the proton
+        # transfer events of this frame as rows of 
+        # [frame, H, old O, new O].
+        #
+        if (cl.nat != self.nat):
+            print "ERROR: topology has ", self.nat, " atoms but the cluster has ", cl.nat, ". EXIT"
+            exit()
+
+        self.iframe+=1
+        c=cl.cell
+        x=cl.x
+
+
+        # Distance of every H to its current O
+        owner=self.Howner[self.Hindx]
+        flagged=owner < 0
+        has=~flagged
+        r=c.mic(x[self.Hindx[has]] - x[owner[has]]).reshape(-1,3)
+        flagged[has]= np.sum(r*r, axis=1) > self.rcheck**2
+
+        events=np.zeros((0,4), dtype=np.int64)
+
+        if flagged.any():
+
+            # Closest O of each flagged H within the cutoff
+            hs=self.Hindx[flagged]
+            ih, jo, r, d = neighborpairs(c, x[hs], self.cutoff, x[self.Oindx])
+            order=np.lexsort((d, ih))
+            ih=ih[order]
+            jo=jo[order]
+            closest=np.r_[True, ih[1:] != ih[:-1]] if len(ih) else np.zeros(0, dtype=bool)
+
+            newowner=np.empty(len(hs), dtype=np.int32)
+            newowner.fill(-1)
+            newowner[ih[closest]]=self.Oindx[jo[closest]]
+
+            moved= newowner != self.Howner[hs]
+            if moved.any():
+                events=np.column_stack((np.repeat(self.iframe, moved.sum()), hs[moved],
+                                        self.Howner[hs[moved]], newowner[moved])).astype(np.int64)
+                self.Howner[hs[moved]]=newowner[moved]
+
+                # Shared Hs that moved now belong to their new O
+                # only, and are lost by every O that had them
+                Os=events[:,2:][events[:,2:] >= 0]
+                lost=np.in1d(self.H2Oindx[:,1:], np.intersect1d(hs[moved], self.Hshared)).reshape(-1,2).any(axis=1)
+                self.Hshared=np.setdiff1d(self.Hshared, hs[moved]).astype(np.int32)
+
+                self.reassign(np.unique(np.concatenate((Os, self.H2Oindx[lost,0]))))
+                self.events=np.vstack((self.events, events))
+
+        self.apply(cl)
+
+        return events
+
+
+
+    def reassign(self, Os):
+        #
+        # Rewrite the rows of the molecules of oxygens Os 
+        # that have exactly two Hs (adding a row if they have
+        # none), and update the list of defects (Os with a 
+        # number of Hs other than two)
+        #
+        nH=np.bincount(self.Howner[self.Howner >= 0], minlength=self.nat)
+
+        # Shared Hs also count for the other Os of their rows
+        O=self.H2Oindx[:,0]
+        other=np.in1d(self.H2Oindx[:,1:], self.Hshared).reshape(-1,2) & \
+              (self.Howner[self.H2Oindx[:,1:]] != O[:,np.newaxis])
+        nH+=np.bincount(np.repeat(O, 2)[other.ravel()], minlength=self.nat)
+
+        # New table: clusters of earlier frames keep theirs
+        if (len(Os) > 0):
+            self.H2Oindx=self.H2Oindx.copy()
+
+        for iO in Os:
+            if (nH[iO] != 2):
+                continue
+
+            irow=self.Orow[iO]
+            if (irow < 0):
+                irow=len(self.H2Oindx)
+                self.H2Oindx=np.vstack((self.H2Oindx, [[iO, -1, -1]])).astype(np.int32)
+                self.Orow[iO]=irow
+
+            # Keep a remaining H in its place
+            old=self.H2Oindx[irow,1:]
+            hs=np.union1d(np.flatnonzero(self.Howner == iO), old[np.in1d(old, self.Hshared)])
+            if (hs[0] == old[1] or hs[1] == old[0]):
+                hs=hs[::-1]
+            self.H2Oindx[irow,1:]=hs
+
+        self.defects=self.Oindx[nH[self.Oindx] != 2].astype(np.int32)
+
+        return
+
+
+
+    def apply(self, cl):
+        #
+        # Set the index arrays of cluster cl from the 
+        # topology, in place of FindAtoms and FindH2Os. The
+        # cluster gets its own copy of ecode, which swap 
+        # permutes in place.
+        #
+        if cl.ecode is None:
+            cl.ecode=self.ecode.copy()
+        cl.Oindx=self.Oindx
+        cl.Hindx=self.Hindx
+        cl.otherindx=self.otherindx
+        cl.H2Oindx=self.H2Oindx
+        cl.nmol=len(self.H2Oindx)
+
+        cl.Hshared=self.Hshared
+        cl.Hunassigned=self.Hindx[self.Howner[self.Hindx] < 0]
+        cl.Odefects=self.defects
+
+        return
+
+
+
+class hbgeometry(object):
+    #
+    # Geometry of all candidate H-bonds of cluster cl,
+    # computed once per frame and shared by any number of 
+    # H-bond definitions (see hbdefs). Candidates are the 
+    # pairs of molecules with rOO <= rcut, from a linked-cell
+    # search, or the pairs of molecule indices given.
+    # For each pair the donated H is the one with the 
+    # smallest intermolecular O-H distance, as in isthisHB.
+    #
+    #  - cl: cluster with H2Oindx set (FindH2Os or topology)
+    #  - rcut: O-O cutoff of the candidates
+    #  - nlist: optional verletlist of the oxygens, kept 
+    #           across frames. Its cutoff must be rcut
+    #  - pairs: optional (imol1, imol2) arrays of candidates
+    #  - c: optional cell object, in place of cl.cell
+    #
+    # Arrays with one entry per candidate:
+    #   donor, acceptor : molecule indices (rows of H2Oindx)
+    #   hdon            : atom index of the donated H
+    #   rOO             : O-O distance
+    #   rOH             : distance from the acceptor O to hdon
+    #   rDH             : distance from the donor O to hdon
+    #   theta           : angle Oa-Od-Hd in radians
+    #
+    def __init__(self, cl, rcut=3.5, nlist=None, pairs=None, c=None):
+
+        if c is None:
+            c=cl.cell
+        x=cl.x
+        mol=cl.H2Oindx
+        xO=x[mol[:,0]]
+
+        self.rcut=rcut
+
+        if pairs is not None:
+            i=np.atleast_1d(np.asarray(pairs[0], dtype=np.int64))
+            j=np.atleast_1d(np.asarray(pairs[1], dtype=np.int64))
+            r=c.mic(xO[j] - xO[i]).reshape(-1,3)
+            rOO=np.sqrt(np.sum(r*r, axis=1))
+        elif nlist is None:
+            i, j, r, rOO = neighborpairs(c, xO, rcut)
+        else:
+            i, j, r, rOO = nlist.update(c, xO)
+
+
+        # The 4 intermolecular O-H vectors and distances:
+        # Oi-Hj1, Oi-Hj2, Oj-Hi1, Oj-Hi2
+        vOH=np.empty((len(i), 4, 3))
+        vOH[:,0]=c.mic(x[mol[j,1]] - xO[i])
+        vOH[:,1]=c.mic(x[mol[j,2]] - xO[i])
+        vOH[:,2]=c.mic(x[mol[i,1]] - xO[j])
+        vOH[:,3]=c.mic(x[mol[i,2]] - xO[j])
+        dOH=np.sqrt(np.sum(vOH*vOH, axis=2))
+
+        k=np.argmin(dOH, axis=1)
+
+
+        # Donor and acceptor of each candidate. For k=0,1 
+        # molecule j donates its H k, for k=2,3 molecule i 
+        # donates its H k-2
+        jdon= k < 2
+        self.donor=np.where(jdon, j, i)
+        self.acceptor=np.where(jdon, i, j)
+        self.hdon=mol[self.donor, np.where(jdon, k+1, k-1)]
+        self.rOO=rOO
+        self.rOH=dOH[np.arange(len(k)), k]
+
+
+        # Angle Oa-Od-Hd at the donor O. Rounding can put the
+        # cosine of near collinear geometries just outside
+        # [-1,1], hence the clip
+        v1=np.where(jdon[:,np.newaxis], -r, r)
+        v2=c.mic(x[self.hdon] - xO[self.donor]).reshape(-1,3)
+        v1norm=np.sqrt(np.sum(v1*v1, axis=1))
+        v2norm=np.sqrt(np.sum(v2*v2, axis=1))
+        self.rDH=v2norm
+        self.theta=np.arccos(np.clip(np.sum(v1*v2, axis=1)/(v1norm*v2norm), -1.0, 1.0))
+
+
+
+    def edges(self, hb):
+        #
+        # donor, acceptor, hdon, rOO, theta of the 
+        # candidates selected by the boolean array hb
+        #
+        return self.donor[hb], self.acceptor[hb], self.hdon[hb], self.rOO[hb], self.theta[hb]
+
+
+
+#
+# H-bond definitions. Each one is a function of an 
+# hbgeometry returning a boolean array (True for the 
+# candidates that are H-bonds), and the O-O distance its
+# candidates need. New ones are added with register_hbdef
+# and can be used by name in find_hbonds_multi and 
+# cluster.isthisHB. Other names of an existing definition
+# are added with register_hbdef_alias and listed in 
+# hbaliases (alias -> name).
+#
+hbdefs={}
+hbaliases={}
+
+
+def register_hbdef(name, func, rOOmax):
+    #
+    #  - name: key of the definition in hbdefs
+    #  - func: func(g) -> boolean array for hbgeometry g
+    #  - rOOmax: largest O-O distance of an H-bond under
+    #            this definition
+    #
+    hbdefs[name]=(func, rOOmax)
+
+
+
+def register_hbdef_alias(alias, name):
+    #
+    # alias: another key of hbdefs for definition name
+    #
+    hbdefs[alias]=hbdefs[name]
+    hbaliases[alias]=name
+
+
+
+def hbdef_rtheta(rOOcut=3.5, thetacut=30.0):
+    #
+    # rOO <= rOOcut and angle Oa-Od-Hd <= thetacut (deg)
+    #
+    thetacut=thetacut*math.pi/180.0
+    def hb(g):
+        return (g.rOO <= rOOcut) & (g.theta <= thetacut)
+    return hb
+
+
+
+def hbdef_rOH(rOHcut=2.45):
+    #
+    # Distance from the acceptor O to the donated H 
+    # rOH <= rOHcut
+    #
+    def hb(g):
+        return g.rOH <= rOHcut
+    return hb
+
+
+
+def hbdef_combined(rOOcut=3.5, rOHcut=2.45, thetacut=30.0):
+    #
+    # rOO <= rOOcut, rOH <= rOHcut and angle Oa-Od-Hd <= 
+    # thetacut (deg)
+    #
+    thetacut=thetacut*math.pi/180.0
+    def hb(g):
+        return (g.rOO <= rOOcut) & (g.rOH <= rOHcut) & (g.theta <= thetacut)
+    return hb
+
+
+
+# HBdef == 1 of isthisHB: Corsetti et. al, JCP 139, 
+# 194502 (2013), Appendix B
+register_hbdef(1, hbdef_rtheta(3.5, 30.0), 3.5)
+
+# Luzar and Chandler, Nature 379, 55 (1996). The same
+# criterion as 1, under its usual name
+register_hbdef_alias('luzar-chandler', 1)
+
+# Acceptor O - donated H distance only. Candidates need
+# rOO <= rOH + the longest O-H bond
+register_hbdef('rOH', hbdef_rOH(2.45), 2.45+1.3)
+
+# Distances and angle
+register_hbdef('combined', hbdef_combined(3.5, 2.45, 30.0), 3.5)
+
+
+
+def find_hbonds(cl, rcut=3.5, thetacut=30.0, nlist=None):
+    #
+    # All H-bonds of the molecules of cluster cl at once,
+    # with the same definition as cluster.isthisHB(HBdef=1)
+    # (Corsetti et. al, JCP 139, 194502 (2013), Appendix B):
+    #   (i)  rOO <= rcut
+    #   (ii) angle Oa-Od-Hd <= thetacut (degrees)
+    # For each pair of molecules the donated H is the one 
+    # with the smallest intermolecular O-H distance.
+    #
+    # O-O candidate pairs come from a linked-cell search,
+    # and the four O-H distances and the angle of all the
+    # candidates are computed as arrays (see hbgeometry),
+    # instead of calling isthisHB for every pair.
+    #
+    #  - cl: cluster with H2Oindx set (FindH2Os or topology)
+    #  - rcut: O-O cutoff (same units as coordinates)
+    #  - thetacut: angle cutoff in degrees
+    #  - nlist: optional verletlist of the oxygens, kept 
+    #           across frames. Its cutoff must be rcut
+    #
+    # Returns arrays with one entry per H-bond
+    #   donor, acceptor : molecule indices (rows of H2Oindx)
+    #   hdon            : atom index of the donated H
+    #   rOO             : O-O distance
+    #   theta           : angle Oa-Od-Hd in radians
+    #
+    g=hbgeometry(cl, rcut, nlist=nlist)
+
+    return g.edges(hbdef_rtheta(rcut, thetacut)(g))
+
+
+
+def find_hbonds_multi(cl, names=None, nlist=None):
+    #
+    # H-bonds of cluster cl under several definitions of
+    # hbdefs (all of them but the aliases if names is 
+    # None). The geometry of the candidates is computed 
+    # once, with the largest O-O distance needed by any of
+    # the definitions, so each extra definition only costs
+    # its own test. Names of the same definition (aliases)
+    # share one test and one result.
+    #
+    #  - nlist: optional verletlist of the oxygens. Its 
+    #           cutoff must be the largest rOOmax of names
+    #
+    # Returns a dict with, for each name, the tuple 
+    # (donor, acceptor, hdon, rOO, theta) of find_hbonds
+    #
+    if names is None:
+        names=[name for name in hbdefs if name not in hbaliases]
+
+    for name in names:
+        if name not in hbdefs:
+            print "ERROR: H-bond definition ", name, " not in hbdefs. EXIT"
+            exit()
+
+    rcut=max([hbdefs[name][1] for name in names])
+    g=hbgeometry(cl, rcut, nlist=nlist)
+
+    hbonds={}
+    done={}
+    for name in names:
+        func=hbdefs[name][0]
+        if func not in done:
+            done[func]=g.edges(func(g))
+        hbonds[name]=done[func]
 
+    return hbonds
 
 
 
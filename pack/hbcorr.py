@@ -0,0 +1,207 @@
+#
+# H-bond time correlation functions.
+#
+# For every donor-acceptor pair that is H-bonded in some
+# frame, h(t)=1 if the pair is H-bonded in frame t and 0
+# otherwise. From these histories
+#
+#   C(t) = <h(t0) h(t0+t)> / <h(t0)>
+#          intermittent correlation: bonded at t0 and t0+t,
+#          whatever happens in between
+#
+#   S(t) = <h(t0) H(t0,t0+t)> / <h(t0)>
+#          continuous correlation: H=1 if the bond is
+#          unbroken from t0 to t0+t
+#
+# averaged over pairs and all time origins t0 with t0+t
+# inside the trajectory (Luzar and Chandler, Nature 379,
+# 55 (1996); Rapaport, Mol. Phys. 50, 1151 (1983)).
+#
+# Histories are stored packed, 64 frames per uint64 word,
+# i.e. one bit per pair and frame. Only pairs that were
+# bonded at least once are stored, and adding a frame
+# only touches its bonds (the row of each pair is looked
+# up in a dict, and new pairs get the next free row).
+# Correlations are computed by blocks of pairs, C(t) with
+# FFTs and S(t) from the lengths of the runs of
+# consecutive bonded frames.
+#
+#
+import numpy as np
+
+
+
+class hbhistory(object):
+    #
+    # Bit-packed H-bond histories of the donor-acceptor
+    # pairs of a trajectory.
+    #
+    #   hist=hbcorr.hbhistory(nmol)
+    #   for ... frames ...:
+    #       donor, acceptor, hdon, rOO, theta = h2o.find_hbonds(allmol)
+    #       hist.add(donor, acceptor)
+    #   C, S = hist.correlations(tmax=50)
+    #
+    #  - n: number of molecules
+    #  - nframes: expected number of frames, to allocate
+    #             the histories at once (optional)
+    #
+    def __init__(self, n, nframes=None):
+
+        self.n=n
+        self.nframes=0
+
+        nwords=1 if nframes is None else max(1, (nframes+63)//64)
+
+        # Row in bits of every pair key donor*n+acceptor.
+        # Rows are given in order of first appearance
+        self.rowof={}
+        self.npairs=0
+
+        # bits[row, t//64] has bit t%64 set if the pair of
+        # row is H-bonded in frame t
+        self.bits=np.zeros((64, nwords), dtype=np.uint64)
+
+        # Number of H-bonds of every frame
+        self.nbonds=[]
+
+
+
+    def add(self, donor, acceptor):
+        #
+        # H-bonds of the next frame. Returns its frame index.
+        #
+        t=self.nframes
+        keys=np.unique(np.asarray(donor, dtype=np.int64)*self.n + np.asarray(acceptor, dtype=np.int64))
+
+
+        # Row of every bond, new pairs get the next rows
+        rows=np.empty(len(keys), dtype=np.int64)
+        rowof=self.rowof
+        for i, key in enumerate(keys.tolist()):
+            row=rowof.get(key)
+            if row is None:
+                row=len(rowof)
+                rowof[key]=row
+            rows[i]=row
+        self.npairs=len(rowof)
+
+
+        # Room for new pairs and frames
+        word=t//64
+        nrows, nwords = self.bits.shape
+        if (self.npairs > nrows or word >= nwords):
+            if (self.npairs > nrows):
+                nrows=max(2*nrows, self.npairs)
+            if (word >= nwords):
+                nwords=max(2*nwords, word+1)
+            grown=np.zeros((nrows, nwords), dtype=np.uint64)
+            grown[:self.bits.shape[0],:self.bits.shape[1]]=self.bits
+            self.bits=grown
+
+
+        self.bits[rows, word] |= np.uint64(1) << np.uint64(t % 64)
+
+        self.nbonds.append(len(keys))
+        self.nframes+=1
+
+        return t
+
+
+
+    def pairs(self):
+        #
+        # Donor and acceptor of the pair of every row
+        #
+        rows=np.fromiter(self.rowof.values(), dtype=np.int64, count=self.npairs)
+        keys=np.empty(self.npairs, dtype=np.int64)
+        keys[rows]=np.fromiter(self.rowof.keys(), dtype=np.int64, count=self.npairs)
+
+        return keys // self.n, keys % self.n
+
+
+
+    def history(self, rows):
+        #
+        # Unpacked histories of rows as a (len(rows), nframes)
+        # boolean array
+        #
+        words=self.bits[rows, :(self.nframes+63)//64]
+        shifts=np.arange(64, dtype=np.uint64)
+        h=(words[:,:,np.newaxis] >> shifts) & np.uint64(1)
+
+        return h.reshape(len(rows), -1)[:, :self.nframes].astype(bool)
+
+
+
+    def runlengths(self, rows):
+        #
+        # Lengths of all runs of consecutive H-bonded frames
+        # of rows
+        #
+        h=self.history(rows).astype(np.int8)
+        pad=np.zeros((len(rows), 1), dtype=np.int8)
+        step=np.diff(np.hstack((pad, h, pad)), axis=1)
+
+        # Starts and ends come in the same order, row by row
+        start=np.nonzero(step == 1)
+        end=np.nonzero(step == -1)
+
+        return end[1] - start[1]
+
+
+
+    def correlations(self, tmax=None, block=None):
+        #
+        # Intermittent C(t) and continuous S(t) correlation
+        # functions for t=0..tmax frames (nframes-1 if None)
+        #
+        #  - block: number of pairs processed together. By
+        #           default, as many as fit in ~256 MB of
+        #           FFT work arrays
+        #
+        T=self.nframes
+        if (T == 0):
+            return np.zeros(0), np.zeros(0)
+        if (tmax is None or tmax > T-1):
+            tmax=T-1
+
+        lags=np.arange(tmax+1)
+        nfft=1
+        while (nfft < 2*T):
+            nfft*=2
+
+        if block is None:
+            block=max(1, (1<<24)//nfft)
+
+        hh=np.zeros(tmax+1)
+        runs=np.zeros(T+1)
+
+        for r0 in range(0, self.npairs, block):
+            rows=np.arange(r0, min(r0+block, self.npairs))
+
+            # sum over t0 of h(t0)h(t0+t), for all pairs in
+            # the block, from the power spectra
+            F=np.fft.rfft(self.history(rows).astype(np.float64), nfft, axis=1)
+            acf=np.fft.irfft((F*F.conj()).real.sum(axis=0), nfft)
+            hh+=acf[:tmax+1]
+
+            runs+=np.bincount(self.runlengths(rows), minlength=T+1)
+
+
+        # Bonds at the origins t0 < T-t of every lag
+        nbonds=np.array(self.nbonds, dtype=np.float64)
+        origins=nbonds.sum() - np.concatenate(([0.0], np.cumsum(nbonds[::-1])))[lags]
+
+
+        # sum over runs of length L > t of the L-t origins
+        # that stay bonded up to t0+t
+        L=np.arange(T+1)
+        ncount=np.cumsum(runs[::-1])[::-1]         # runs of length >= L
+        nlength=np.cumsum((runs*L)[::-1])[::-1]    # total length of those
+        unbroken=nlength[lags+1] - lags*ncount[lags+1]
+
+        C=np.rint(hh)/origins
+        S=unbroken/origins
+
+        return C, S
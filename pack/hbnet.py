@@ -0,0 +1,671 @@
+#
+# H-bond network analysis on sparse directed graphs.
+#
+# The network of a frame is given by the edge arrays
+# (donor, acceptor) of h2o.find_hbonds: an edge i --> j
+# means molecule i donates an H-bond to molecule j, i.e.
+# Adj[i,j]=1 in the adjacency matrix. Only the edges are
+# stored, so memory and time scale with the number of
+# H-bonds instead of nmol^2.
+#
+#
+import numpy as np
+try:
+    import scipy.sparse as sparse
+    from scipy.sparse.csgraph import connected_components
+except ImportError:
+    sparse = None   # python strongly connected components only
+
+
+
+class graph(object):
+    #
+    # Directed graph of n nodes in compressed sparse row
+    # form. Node i has outgoing edges to
+    #     indices[indptr[i]:indptr[i+1]]
+    # sorted by node. Repeated edges are kept once.
+    #
+    #  - n: number of nodes (molecules)
+    #  - src, dst: edge arrays src --> dst (donor, acceptor)
+    #
+    def __init__(self, n, src, dst):
+
+        self.n=n
+
+        src=np.asarray(src, dtype=np.int64)
+        dst=np.asarray(dst, dtype=np.int64)
+        if (len(src) != len(dst)):
+            print "ERROR: src and dst must have the same length. EXIT"
+            exit()
+        if (len(src) > 0 and (min(src.min(), dst.min()) < 0 or max(src.max(), dst.max()) >= n)):
+            print "ERROR: edge with node index out of range 0..", n-1, ". EXIT"
+            exit()
+
+        # Unique edges sorted by src and then dst
+        key=np.unique(src*n + dst)
+        self.src=key // n
+        self.dst=key - self.src*n
+        self.nedges=len(key)
+
+        self.indptr=np.searchsorted(self.src, np.arange(n+1))
+        self.indices=self.dst
+
+        self.outdeg=np.diff(self.indptr)
+        self.indeg=np.bincount(self.dst, minlength=n)
+
+
+
+    def matvec(self, V):
+        #
+        # Adj*V for a (n,) or (n,b) array V: row i is the sum
+        # of the rows of V of the nodes i points to
+        #
+        out=np.zeros(V.shape, dtype=V.dtype)
+        if (self.nedges == 0):
+            return out
+
+        # Sums over the edges of each node with outgoing edges
+        rows=np.flatnonzero(self.outdeg)
+        out[rows]=np.add.reduceat(V[self.indices], self.indptr[rows], axis=0)
+
+        return out
+
+
+
+def walkstep(g, src, node, count):
+    #
+    # One step of walks counted as sparse triples: count
+    # walks from src end at node. Returns the triples of
+    # the walks one edge longer, sorted by (src, node).
+    #
+    deg=g.outdeg[node]
+    total=deg.sum()
+    w=np.repeat(np.arange(len(node)), deg)
+    pos=np.arange(total) - np.repeat(np.cumsum(deg) - deg, deg)
+    nxt=g.indices[g.indptr[node][w] + pos]
+
+    return combine(src[w], nxt, count[w], g.n)
+
+
+
+def combine(src, node, count, n):
+    #
+    # Sum the counts of repeated (src, node) triples
+    #
+    key=src*n + node
+    order=np.argsort(key, kind='mergesort')
+    key=key[order]
+    if (len(key) == 0):
+        return src[:0], node[:0], count[:0]
+    first=np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    key=key[first]
+
+    return key // n, key % n, np.add.reduceat(count[order], first)
+
+
+
+def closedwalks(g, K, block=4096):
+    #
+    # Number of closed walks of length k through each node,
+    # diag(Adj^k), for k=1..K. For an H-bond network these
+    # are the numbers of H-bond loops of length k of each
+    # molecule.
+    #
+    # Walks of length a=ceil(k/2) leaving node i and of
+    # length b=k-a arriving at it are counted with sparse
+    # walks from i over its ceil(K/2)-hop neighborhood only
+    # (along and against the edges), and
+    #     (Adj^k)[i,i] = sum_j (Adj^a)[i,j] (Adj^b)[j,i]
+    # so no nmol x nmol matrix is ever formed. The cost
+    # grows linearly with the number of nodes (for a given
+    # K and neighborhood size), instead of as nmol^3.
+    #
+    #  - g: graph
+    #  - K: largest walk length
+    #  - block: number of nodes processed together
+    #
+    # Returns an (n,K) array W with W[i,k-1] = (Adj^k)[i,i].
+    # The integer type is int64, or python integers (object
+    # arrays) if the counts could overflow int64.
+    #
+    n=g.n
+
+    # Entries of Adj^k are at most maxdeg^k
+    maxdeg=max(int(g.outdeg.max()), 1) if n > 0 else 1
+    if (maxdeg**K < np.iinfo(np.int64).max):
+        dtype=np.int64
+    else:
+        dtype=object
+
+    W=np.zeros((n, K), dtype=dtype)
+    gT=graph(n, g.dst, g.src)
+
+    for i0 in range(0, n, block):
+        src=np.arange(i0, min(i0+block, n))
+
+        # Walks out of (fwd) and into (bwd) the sources of
+        # length 0..ceil(K/2), as sorted (src, node, count)
+        fwd=[(src, src, np.ones(len(src), dtype=dtype))]
+        bwd=[fwd[0]]
+        for t in range((K+1)//2):
+            fwd.append(walkstep(g, *fwd[-1]))
+        for t in range(K//2):
+            bwd.append(walkstep(gT, *bwd[-1]))
+
+        for k in range(1, K+1):
+            a=(k+1)//2
+            fs, fn, fc = fwd[a]
+            bs, bn, bc = bwd[k-a]
+
+            # Pairs (src, node) present in both
+            common, jf, jb = np.intersect1d(fs*n + fn, bs*n + bn, assume_unique=True, return_indices=True)
+            if (len(common) == 0):
+                continue
+            prod=fc[jf]*bc[jb]
+            s=common // n
+            first=np.flatnonzero(np.r_[True, s[1:] != s[:-1]])
+            W[s[first], k-1]=np.add.reduceat(prod, first)
+
+    return W
+
+
+
+def undirected(g):
+    #
+    # Graph with the edges of g in both directions, i.e.
+    # the H-bond network without donor/acceptor roles
+    #
+    return graph(g.n, np.concatenate((g.src, g.dst)), np.concatenate((g.dst, g.src)))
+
+
+
+def degrees(g):
+    #
+    # In-degree (accepted H-bonds), out-degree (donated 
+    # H-bonds) and degree of every node, the latter as the
+    # number of neighbors ignoring the direction of edges
+    #
+    return g.indeg, g.outdeg, undirected(g).outdeg
+
+
+
+def degreedist(deg, maxdeg=None):
+    #
+    # Distribution of the degrees deg: number of nodes
+    # with degree 0, 1, ..., maxdeg
+    #
+    if maxdeg is None:
+        maxdeg=deg.max() if len(deg) > 0 else 0
+
+    return np.bincount(np.minimum(deg, maxdeg), minlength=maxdeg+1)
+
+
+
+def degreecentrality(g):
+    #
+    # Degree centrality of every node: degree over n-1,
+    # as in-degree, out-degree and ignoring directions
+    #
+    indeg, outdeg, deg = degrees(g)
+    norm=1.0/(g.n-1) if g.n > 1 else 1.0
+
+    return indeg*norm, outdeg*norm, deg*norm
+
+
+
+def relabel(labels):
+    #
+    # Component labels as 0..ncomp-1, in the order of the
+    # smallest node of each component. Returns labels and
+    # ncomp.
+    #
+    u, first, labels = np.unique(labels, return_index=True, return_inverse=True)
+    rank=np.argsort(np.argsort(first))
+
+    return rank[labels], len(u)
+
+
+
+def components(g):
+    #
+    # Connected components of g ignoring the direction of
+    # edges (weakly connected components).
+    #
+    # Every node takes the smallest label among itself and
+    # its neighbors, for all edges at once, and labels are
+    # then followed to their root (pointer jumping) until
+    # nothing changes.
+    #
+    # Returns the component of every node (numbered from
+    # 0 in the order of their smallest node) and the 
+    # number of components.
+    #
+    labels=np.arange(g.n)
+
+    while True:
+        old=labels
+        labels=labels.copy()
+        np.minimum.at(labels, g.src, labels[g.dst])
+        np.minimum.at(labels, g.dst, labels[g.src])
+
+        # Pointer jumping
+        while True:
+            jump=labels[labels]
+            if np.array_equal(jump, labels):
+                break
+            labels=jump
+
+        if np.array_equal(labels, old):
+            break
+
+    return relabel(labels)
+
+
+
+def strongcomponents(g):
+    #
+    # Strongly connected components of g (sets of nodes
+    # connected by directed paths both ways), from scipy's
+    # csgraph if available, or else with Tarjan's algorithm
+    # (see tarjan).
+    #
+    # Returns the component of every node (numbered from
+    # 0 in the order of their smallest node) and the 
+    # number of components.
+    #
+    if sparse is None:
+        return tarjan(g)
+
+    M=sparse.csr_matrix((np.ones(g.nedges, dtype=np.int8), g.indices, g.indptr), shape=(g.n, g.n))
+    ncomp, labels = connected_components(M, directed=True, connection='strong')
+
+    return relabel(labels)
+
+
+
+def tarjan(g):
+    #
+    # Strongly connected components of g with Tarjan's
+    # algorithm, in python. The depth-first search is
+    # iterative, with an explicit stack, so the size of the
+    # network is not limited by the recursion limit.
+    #
+    # Returns the same as strongcomponents.
+    #
+    n=g.n
+    indptr=g.indptr.tolist()
+    indices=g.indices.tolist()
+
+    index=[-1]*n
+    low=[0]*n
+    onstack=[False]*n
+    labels=np.zeros(n, dtype=np.int64)
+
+    stack=[]
+    counter=0
+    ncomp=0
+
+    for root in range(n):
+        if (index[root] >= 0):
+            continue
+
+        # Depth-first search: (node, position of the next
+        # edge to follow)
+        work=[(root, indptr[root])]
+        index[root]=low[root]=counter
+        counter+=1
+        stack.append(root)
+        onstack[root]=True
+
+        while work:
+            v, pos = work[-1]
+
+            if (pos < indptr[v+1]):
+                work[-1]=(v, pos+1)
+                w=indices[pos]
+                if (index[w] < 0):
+                    index[w]=low[w]=counter
+                    counter+=1
+                    stack.append(w)
+                    onstack[w]=True
+                    work.append((w, indptr[w]))
+                elif onstack[w]:
+                    low[v]=min(low[v], index[w])
+                continue
+
+            # All edges of v followed
+            work.pop()
+            if work:
+                u=work[-1][0]
+                low[u]=min(low[u], low[v])
+
+            if (low[v] == index[v]):
+                while True:
+                    w=stack.pop()
+                    onstack[w]=False
+                    labels[w]=ncomp
+                    if (w == v):
+                        break
+                ncomp+=1
+
+    return relabel(labels)
+
+
+
+def stats(g):
+    #
+    # Per-frame statistics of the H-bond network g. Returns
+    # a dict with
+    #   indeg, outdeg, deg : degrees of every node
+    #   indist, outdist, degdist : their distributions
+    #   centrality : degree centrality (no directions)
+    #   comp, ncomp : connected components
+    #   scomp, nscomp : strongly connected components
+    #
+    indeg, outdeg, deg = degrees(g)
+    comp, ncomp = components(g)
+    scomp, nscomp = strongcomponents(g)
+    norm=1.0/(g.n-1) if g.n > 1 else 1.0
+
+    return {'indeg': indeg, 'outdeg': outdeg, 'deg': deg,
+            'indist': degreedist(indeg), 'outdist': degreedist(outdeg), 'degdist': degreedist(deg),
+            'centrality': deg*norm,
+            'comp': comp, 'ncomp': ncomp, 'scomp': scomp, 'nscomp': nscomp}
+
+
+
+def notin(a, b):
+    #
+    # Elements of the sorted array a that are not in the
+    # sorted array b, found by binary search
+    #
+    if (len(b) == 0):
+        return a
+    pos=np.minimum(np.searchsorted(b, a), len(b)-1)
+
+    return a[b[pos] != a]
+
+
+
+class hbnetwork(object):
+    #
+    # H-bond network of a trajectory, updated frame by 
+    # frame with the edges that were formed or broken
+    # instead of being rebuilt. Between MD frames only a
+    # few percent of the H-bonds change.
+    #
+    #   net=hbnet.hbnetwork(nmol)
+    #   for ... frames ...:
+    #       donor, acceptor, hdon, rOO, theta = h2o.find_hbonds(allmol)
+    #       added, removed = net.update(donor, acceptor)
+    #
+    # Kept up to date:
+    #   indeg, outdeg : accepted and donated H-bonds of 
+    #                   every molecule
+    #   deg           : neighbors ignoring the direction
+    #   comp, ncomp   : connected components (ignoring the
+    #                   direction of edges)
+    #   events        : if keepevents, all edge changes as 
+    #                   rows of [frame, donor, acceptor, +1]
+    #                   (formed) or [..., -1] (broken)
+    #
+    # Components are kept as labels joined by a union-find
+    # when edges are formed. A broken edge is checked with a
+    # bidirectional breadth-first search between its ends,
+    # which stops as soon as they meet (in liquid water,
+    # after a few steps around a ring). If they are no
+    # longer connected, the side whose search ran out first
+    # gets a new label. A search that visits more than
+    # maxvisit nodes is given up, and that component is
+    # recomputed from scratch at the end of the frame.
+    #
+    #  - n: number of molecules
+    #  - keepevents: keep the stream of all events
+    #  - maxvisit: largest search for a broken edge
+    #
+    def __init__(self, n, keepevents=True, maxvisit=4096):
+
+        self.n=n
+        self.keepevents=keepevents
+        self.maxvisit=maxvisit
+        self.iframe=-1
+
+        # Sorted edge keys donor*n+acceptor and undirected 
+        # keys min*n+max
+        self.keys=np.zeros(0, dtype=np.int64)
+        self.ukeys=np.zeros(0, dtype=np.int64)
+
+        # Neighbors of every node, ignoring directions
+        self.nbrs=[set() for i in range(n)]
+
+        self.indeg=np.zeros(n, dtype=np.int64)
+        self.outdeg=np.zeros(n, dtype=np.int64)
+        self.deg=np.zeros(n, dtype=np.int64)
+
+        # Every molecule is its own component at first
+        self.comp=np.arange(n)
+        self.ncomp=n
+
+        self.eventlist=[]
+
+
+
+    def update(self, donor, acceptor):
+        #
+        # Network of the next frame, given by its edges.
+        # Returns the (nadded,2) and (nremoved,2) arrays of
+        # [donor, acceptor] of the edges formed and broken 
+        # since the previous frame.
+        #
+        n=self.n
+        self.iframe+=1
+
+        donor=np.asarray(donor, dtype=np.int64)
+        acceptor=np.asarray(acceptor, dtype=np.int64)
+        keys=np.unique(donor*n + acceptor)
+        ukeys=np.unique(np.minimum(donor, acceptor)*n + np.maximum(donor, acceptor))
+
+
+        # Edge diffs
+        added=notin(keys, self.keys)
+        removed=notin(self.keys, keys)
+        uadded=notin(ukeys, self.ukeys)
+        uremoved=notin(self.ukeys, ukeys)
+        self.keys=keys
+        self.ukeys=ukeys
+
+
+        # Degrees
+        self.outdeg+=np.bincount(added // n, minlength=n) - np.bincount(removed // n, minlength=n)
+        self.indeg+=np.bincount(added % n, minlength=n) - np.bincount(removed % n, minlength=n)
+        self.deg+=self.ends(uadded) - self.ends(uremoved)
+
+
+        # Components. The union-find starts from the labels
+        # of the previous frame (comp). New edges are joined
+        # first, and broken ones removed one by one, so that
+        # the labels are always the components of the edges
+        # in nbrs.
+        if (len(uadded) > 0 or len(uremoved) > 0):
+            self.parent=range(self.ncomp)
+            self.merge(uadded)
+            dirty=self.split(uremoved)
+            self.resolve(dirty)
+
+
+        added=np.column_stack((added // n, added % n))
+        removed=np.column_stack((removed // n, removed % n))
+
+        if self.keepevents:
+            frame=np.empty((len(added)+len(removed), 1), dtype=np.int64)
+            frame.fill(self.iframe)
+            sign=np.concatenate((np.ones(len(added), dtype=np.int64), -np.ones(len(removed), dtype=np.int64)))
+            self.eventlist.append(np.hstack((frame, np.vstack((added, removed)), sign[:,np.newaxis])))
+
+        return added, removed
+
+
+
+    def ends(self, ukeys):
+        #
+        # Number of undirected edges ukeys at every node
+        # (a self-loop counts once, as in undirected(g))
+        #
+        n=self.n
+        i=ukeys // n
+        j=ukeys % n
+
+        return np.bincount(i, minlength=n) + np.bincount(j[j != i], minlength=n)
+
+
+
+    def find(self, a):
+        #
+        # Root label of label a, with path halving
+        #
+        parent=self.parent
+        while (parent[a] != a):
+            parent[a]=parent[parent[a]]
+            a=parent[a]
+
+        return a
+
+
+
+    def merge(self, uadded):
+        #
+        # Add the new edges to nbrs and join the labels of 
+        # their ends
+        #
+        n=self.n
+        nbrs=self.nbrs
+        parent=self.parent
+        comp=self.comp
+
+        for i, j in zip((uadded // n).tolist(), (uadded % n).tolist()):
+            nbrs[i].add(j)
+            nbrs[j].add(i)
+            a=self.find(comp[i])
+            b=self.find(comp[j])
+            if (a != b):
+                parent[max(a, b)]=min(a, b)
+
+
+
+    def split(self, uremoved):
+        #
+        # Remove the broken edges from nbrs one by one and 
+        # give a new label to the part of a component that
+        # gets disconnected. Returns the root labels of the
+        # components left to recompute.
+        #
+        n=self.n
+        nbrs=self.nbrs
+        parent=self.parent
+        dirty=set()
+
+        for i, j in zip((uremoved // n).tolist(), (uremoved % n).tolist()):
+            nbrs[i].discard(j)
+            nbrs[j].discard(i)
+            if (i == j):
+                continue
+            root=self.find(self.comp[i])
+            if root in dirty:
+                continue
+
+            apart, side = self.search(i, j)
+            if apart is None:
+                dirty.add(root)
+            elif apart:
+                parent.append(len(parent))
+                self.comp[list(side)]=len(parent)-1
+
+        return dirty
+
+
+
+    def search(self, i, j):
+        #
+        # Bidirectional breadth-first search between nodes i
+        # and j, expanding the smaller frontier each step.
+        # Returns (False, None) if they are connected, 
+        # (True, nodes) with the nodes on the side of the 
+        # search that ran out first if they are not, and
+        # (None, None) after maxvisit nodes.
+        #
+        nbrs=self.nbrs
+        seen=[set([i]), set([j])]
+        front=[[i], [j]]
+
+        while True:
+            s=0 if (len(front[0]) <= len(front[1])) else 1
+            mine=seen[s]
+            nxt=set()
+            for u in front[s]:
+                nxt.update(nbrs[u])
+            nxt-=mine
+            if not nxt.isdisjoint(seen[1-s]):
+                return False, None
+            if not nxt:
+                return True, mine
+            mine|=nxt
+            front[s]=nxt
+
+            if (len(seen[0]) + len(seen[1]) > self.maxvisit):
+                return None, None
+
+
+
+    def resolve(self, dirty):
+        #
+        # Follow every label to its root, recompute the
+        # components given up by split from the edges of the
+        # current frame within them, and number components
+        # in the order of their smallest node
+        #
+        n=self.n
+        parent=np.array(self.parent)
+        while True:
+            jump=parent[parent]
+            if np.array_equal(jump, parent):
+                break
+            parent=jump
+        comp=parent[self.comp]
+
+        if dirty:
+            inside=np.in1d(comp, list(dirty))
+            nodes=np.flatnonzero(inside)
+
+            i=self.ukeys // n
+            j=self.ukeys % n
+            keep=inside[i] & inside[j]
+
+            # Subgraph with the nodes renumbered 0..len(nodes)-1
+            local=np.empty(n, dtype=np.int64)
+            local[nodes]=np.arange(len(nodes))
+            sub, nsub = components(graph(len(nodes), local[i[keep]], local[j[keep]]))
+            comp[nodes]=len(parent) + sub
+
+        self.comp, self.ncomp = relabel(comp)
+
+
+
+    def graph(self):
+        #
+        # Network of the current frame as a graph
+        #
+        return graph(self.n, self.keys // self.n, self.keys % self.n)
+
+
+
+    def events(self):
+        #
+        # All events so far as an (nevents,4) array of rows 
+        # [frame, donor, acceptor, +1 formed or -1 broken]
+        #
+        if not self.eventlist:
+            return np.zeros((0,4), dtype=np.int64)
+        if (len(self.eventlist) > 1):
+            self.eventlist=[np.vstack(self.eventlist)]
+
+        return self.eventlist[0]
@@ -0,0 +1,232 @@
+#
+# Ring statistics of the H-bond network.
+#
+# Closed walks (diag(Adj^k), see hbnet.closedwalks) count
+# every loop many times, with backtracking and repeated
+# cycles. Here rings are counted instead, with the
+# shortest-path criterion of King (Nature 213, 1112 (1967))
+# and Franzblau (PRB 44, 4925 (1991)): a ring is counted if
+# there is no shortcut through the network between any two
+# of its nodes, i.e. the distance in the network between
+# any two nodes equals their distance along the ring.
+# Shortest-path rings are also primitive rings (rings that
+# are not the sum of two smaller rings).
+#
+# Rings can be undirected (H-bonds as undirected edges) or
+# directed (every H-bond followed from donor to acceptor).
+#
+# Rings are found with breadth-first searches of bounded
+# depth from every node s, among the nodes with a larger
+# index only, so every ring is built once, from its
+# smallest node. The cost per node depends on the ring
+# size limit and the degree, not on the number of nodes.
+#
+#
+import numpy as np
+
+
+
+def neighbors(g, directed=False):
+    #
+    # Lists of neighbors of every node of the graph g
+    # (hbnet.graph). Outgoing neighbors if directed,
+    # neighbors through edges in any direction if not.
+    #
+    if directed:
+        src=g.src
+        dst=g.dst
+    else:
+        src=np.concatenate((g.src, g.dst))
+        dst=np.concatenate((g.dst, g.src))
+        key=np.unique(src*g.n + dst)
+        src=key // g.n
+        dst=key - src*g.n
+
+    indptr=np.searchsorted(src, np.arange(g.n+1))
+    dst=dst.tolist()
+
+    return [dst[indptr[i]:indptr[i+1]] for i in range(g.n)]
+
+
+
+def bfs(nbr, s, depth, lo=None):
+    #
+    # Breadth-first search from s up to depth, only through
+    # nodes > lo if lo is given. Returns the distances of
+    # the nodes reached and, for each of them, the list of
+    # their predecessors in shortest paths from s.
+    #
+    dist={s: 0}
+    pred={s: []}
+    frontier=[s]
+
+    for d in range(1, depth+1):
+        new=[]
+        for u in frontier:
+            for v in nbr[u]:
+                if (lo is not None and v <= lo):
+                    continue
+                if v not in dist:
+                    dist[v]=d
+                    pred[v]=[u]
+                    new.append(v)
+                elif (dist[v] == d):
+                    pred[v].append(u)
+        if not new:
+            break
+        frontier=new
+
+    return dist, pred
+
+
+
+def shortestpaths(pred, t, paths):
+    #
+    # All shortest paths from the source of pred to t, as
+    # tuples of nodes. paths is a dict of the paths found
+    # so far, filled as they are needed.
+    #
+    if t not in paths:
+        if not pred[t]:
+            paths[t]=[(t,)]
+        else:
+            paths[t]=[p + (t,) for u in pred[t] for p in shortestpaths(pred, u, paths)]
+
+    return paths[t]
+
+
+
+def isSPring(ring, nbr, cache, depth, directed):
+    #
+    # True if no two nodes of ring are closer in the
+    # network than along the ring. cache holds the bounded
+    # distances from every node checked so far.
+    #
+    m=len(ring)
+    for a in range(m):
+        if ring[a] not in cache:
+            cache[ring[a]]=bfs(nbr, ring[a], depth)[0]
+        dist=cache[ring[a]]
+
+        for b in range(m):
+            if (b == a):
+                continue
+            if directed:
+                along=(b - a) % m
+            else:
+                along=min(abs(b - a), m - abs(b - a))
+            if (dist.get(ring[b], m) < along):
+                return False
+
+    return True
+
+
+
+def findrings(g, maxsize=10, directed=False):
+    #
+    # All shortest-path rings of the graph g (hbnet.graph)
+    # with up to maxsize nodes.
+    #
+    #  - directed: if True, rings follow the edges from
+    #              donor to acceptor
+    #
+    # Returns a list of rings, each a tuple of nodes that
+    # starts at its smallest node. Undirected rings go
+    # towards the smaller of the two neighbors of the first
+    # node, directed rings along the edges.
+    #
+    nbr=neighbors(g, directed)
+    cache={}
+    rings=[]
+
+    if directed:
+        depth=maxsize-1
+        inward=neighbors(graphT(g), True)
+    else:
+        depth=maxsize//2
+
+
+    for s in range(g.n):
+
+        # Search among the nodes > s only: s is the smallest
+        # node of the rings built from it
+        dist, pred = bfs(nbr, s, depth, lo=s)
+        paths={}
+        candidates=[]
+
+        if directed:
+
+            # A path s --> t that is a shortest path, closed
+            # by an edge t --> s
+            for t in inward[s]:
+                if (t > s and t in dist):
+                    candidates.extend(shortestpaths(pred, t, paths))
+
+        else:
+
+            # Even rings: two shortest paths from s to the
+            # node t opposite to s
+            for t, d in dist.items():
+                if (d < 2):
+                    continue
+                tp=shortestpaths(pred, t, paths)
+                for ip in range(len(tp)):
+                    for iq in range(ip+1, len(tp)):
+                        p=tp[ip]
+                        q=tp[iq]
+                        if not set(p[1:-1]) & set(q[1:-1]):
+                            candidates.append(p + q[-2:0:-1])
+
+            # Odd rings: shortest paths from s to the two
+            # ends u < v of the edge opposite to s
+            for u, d in dist.items():
+                if (d < 1 or 2*d+1 > maxsize):
+                    continue
+                for v in nbr[u]:
+                    if (v <= u or dist.get(v) != d):
+                        continue
+                    for p in shortestpaths(pred, u, paths):
+                        for q in shortestpaths(pred, v, paths):
+                            if not set(p[1:]) & set(q[1:]):
+                                candidates.append(p + q[:0:-1])
+
+
+        for ring in candidates:
+            if isSPring(ring, nbr, cache, depth, directed):
+                if (not directed and ring[-1] < ring[1]):
+                    ring=(ring[0],) + ring[:0:-1]
+                rings.append(ring)
+
+    return rings
+
+
+
+def graphT(g):
+    #
+    # Graph g with all edges reversed
+    #
+    return type(g)(g.n, g.dst, g.src)
+
+
+
+def ringhistograms(rings, n, maxsize=10):
+    #
+    # Ring size histograms of a list of rings of a network
+    # of n nodes.
+    #
+    # Returns
+    #   permol   : (n, maxsize+1) array. permol[i,m] is the
+    #              number of rings of size m with node i
+    #   perframe : (maxsize+1,) array. perframe[m] is the
+    #              number of rings of size m
+    #
+    permol=np.zeros((n, maxsize+1), dtype=np.int64)
+    perframe=np.zeros(maxsize+1, dtype=np.int64)
+
+    if rings:
+        sizes=np.array([len(ring) for ring in rings])
+        nodes=np.concatenate([np.array(ring) for ring in rings])
+        np.add.at(permol, (nodes, np.repeat(sizes, sizes)), 1)
+        perframe+=np.bincount(sizes, minlength=maxsize+1)[:maxsize+1]
+
+    return permol, perframe
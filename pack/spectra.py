@@ -0,0 +1,362 @@
+#
+# Extreme eigenvalues of the H-bond network.
+#
+# The adjacency matrix A of the undirected network and its
+# normalized Laplacian
+#     L_n = I - D^(-1/2) A D^(-1/2)
+# (D the diagonal matrix of degrees, with L_n[i,i]=0 for
+# isolated nodes) are kept sparse, and only k eigenvalues
+# at one end of the spectrum are computed, with the Lanczos
+# solver of scipy (eigsh). Over a trajectory the solver
+# can start from the eigenvectors of the previous frame
+# (see class spectrum).
+#
+# Eigenvalues repeated once per component, which Lanczos
+# misses, are given directly from their known eigenvectors:
+# 0 of L_n (one per component, see nullspace) and 2 of L_n
+# (one per bipartite component, see bipartite).
+#
+# Lanczos can also miss copies of other repeated
+# eigenvalues (e.g. of A, from identical small components)
+# without any error, so the sparse results are checked and
+# completed (see complete) before they are returned.
+#
+# Small networks, or when scipy is not available, use the
+# dense eigensolver of numpy.
+#
+#
+import numpy as np
+try:
+    import scipy.sparse as sparse
+    from scipy.sparse.linalg import eigsh, LinearOperator
+except ImportError:
+    sparse = None   # dense eigenvalues only
+import hbnet
+
+
+
+def adjacency(g):
+    #
+    # Sparse symmetric adjacency matrix of the graph g
+    # (hbnet.graph) ignoring the direction of edges
+    #
+    u=hbnet.undirected(g)
+    data=np.ones(u.nedges)
+
+    if sparse is None:
+        M=np.zeros((u.n, u.n))
+        M[u.src, u.dst]=data
+        return M
+
+    return sparse.csr_matrix((data, u.indices, u.indptr), shape=(u.n, u.n))
+
+
+
+def laplacian(g):
+    #
+    # Sparse normalized Laplacian L_n of the graph g
+    # ignoring the direction of edges
+    #
+    u=hbnet.undirected(g)
+    deg=u.outdeg.astype(np.float64)
+    dinv=np.zeros(u.n)
+    dinv[deg > 0]=1.0/np.sqrt(deg[deg > 0])
+
+    data=-dinv[u.src]*dinv[u.dst]
+    diag=(deg > 0).astype(np.float64)
+
+    if sparse is None:
+        M=np.diag(diag)
+        M[u.src, u.dst]=data
+        return M
+
+    return sparse.csr_matrix((data, u.indices, u.indptr), shape=(u.n, u.n)) + sparse.diags(diag)
+
+
+
+def nullspace(g):
+    #
+    # Null space of L_n: one vector per connected component
+    # C of g, D^(1/2) restricted to C (e_i for an isolated
+    # node i), normalized. Returned as the component of
+    # every node and the entries of all the vectors, 
+    # z[i] being the entry of node i in the vector of its
+    # component.
+    #
+    comp, ncomp = hbnet.components(g)
+    deg=hbnet.undirected(g).outdeg.astype(np.float64)
+    z=np.where(deg > 0, np.sqrt(deg), 1.0)
+    z=z/np.sqrt(np.bincount(comp, weights=z*z, minlength=ncomp))[comp]
+
+    return comp, z
+
+
+
+def bipartite(g):
+    #
+    # Eigenvectors of L_n with eigenvalue 2: one per
+    # bipartite component C of g with edges, D^(1/2)
+    # restricted to C with the sign flipped on one side
+    # of C, normalized. Returned as in nullspace(), with
+    # comp=-1 (and z=0) for the nodes of the other
+    # components.
+    #
+    # Sides are read from the components of the bipartite
+    # double cover of g (nodes i and i+n, an edge i-j
+    # giving i-(j+n) and (i+n)-j): i and i+n are connected
+    # only if the component of i has an odd cycle.
+    #
+    u=hbnet.undirected(g)
+    n=u.n
+    cover=hbnet.graph(2*n, np.concatenate((u.src, u.src+n)), np.concatenate((u.dst+n, u.dst)))
+    side, nside = hbnet.components(cover)
+    comp, ncomp = hbnet.components(u)
+
+    # Components with edges and no odd cycle
+    odd=np.bincount(comp, weights=(side[:n] == side[n:]), minlength=ncomp) > 0
+    edges=np.bincount(comp, weights=u.outdeg, minlength=ncomp) > 0
+    keep=edges & ~odd
+
+    # Sign +1 on the side of the smallest node of each
+    # component (components are numbered in that order)
+    first=np.flatnonzero(np.r_[True, np.diff(np.sort(comp)) > 0])
+    root=np.argsort(comp, kind='mergesort')[first]
+    sign=np.where(side[:n] == side[root[comp]], 1.0, -1.0)
+
+    label=np.cumsum(keep) - 1
+    inside=keep[comp]
+    comp=np.where(inside, label[comp], -1)
+    z=np.where(inside, sign*np.sqrt(u.outdeg.astype(np.float64)), 0.0)
+    if inside.any():
+        norm=np.sqrt(np.bincount(comp[inside], weights=z[inside]**2))
+        z[inside]=z[inside]/norm[comp[inside]]
+
+    return comp, z
+
+
+
+def extremeeigs(M, k=6, which='LA', v0=None, dense=200, null=None, top=None,
+                maxrestart=5, densemax=5000):
+    #
+    # k largest (which='LA') or smallest (which='SA')
+    # eigenvalues of the symmetric matrix M, in ascending
+    # order, and their eigenvectors as columns.
+    #
+    #  - v0: starting vector for the sparse solver
+    #  - dense: matrices with up to this many rows, or
+    #           with k >= n-1, use the dense solver
+    #  - null: known null space of M, as returned by
+    #          nullspace(). Its eigenvalues are not searched
+    #          for, which for L_n avoids Lanczos missing
+    #          copies of the eigenvalue 0 (one per component)
+    #  - top: known eigenvectors of the largest eigenvalue
+    #         of M, 2 for L_n, as returned by bipartite(),
+    #         used the same way with which='LA'
+    #  - maxrestart, densemax: see complete
+    #
+    n=M.shape[0]
+    k=min(k, n)
+
+    if (which not in ('LA', 'SA')):
+        print "ERROR: which must be 'LA' or 'SA'. EXIT"
+        exit()
+
+    if (sparse is None or n <= dense or k >= n-1):
+        return denseeigs(M, k, which)
+
+
+    # Lanczos converges fast for the largest eigenvalues.
+    # The smallest ones of M are the largest ones of cI-M,
+    # with c an upper bound of the spectrum (Gershgorin)
+    if (which == 'LA' and top is None):
+        w, v = eigsh(M, k=k, which='LA', v0=v0)
+    elif (which == 'LA'):
+        w, v = deflated(M, k, 2.0, top, 1.0, 0.0, v0)
+    elif null is None:
+        c=abs(M).sum(axis=1).max()
+        w, v = eigsh(c*sparse.identity(n, format='csr') - M, k=k, which='LA', v0=v0)
+        w=c - w
+    else:
+        c=abs(M).sum(axis=1).max()
+        w, v = deflated(M, k, 0.0, null, -1.0, c, v0)
+
+    return complete(M, k, which, w, v, maxrestart, densemax)
+
+
+
+def denseeigs(M, k, which):
+    #
+    # k extreme eigenpairs of M from the dense solver
+    #
+    n=M.shape[0]
+    if (sparse is not None and sparse.issparse(M)):
+        M=M.toarray()
+    w, v = np.linalg.eigh(M)
+    if (which == 'LA'):
+        return w[n-k:], v[:,n-k:]
+    return w[:k], v[:,:k]
+
+
+
+def complete(M, k, which, w, v, maxrestart=5, densemax=5000):
+    #
+    # Check the k extreme eigenpairs w, v of the sparse
+    # symmetric M returned by the Lanczos solver, and add
+    # the eigenvalues it missed. Returned in ascending order.
+    #
+    # Every pair must have a small residual, and the extreme
+    # eigenvalue of M with the vectors v projected out must
+    # not lie beyond the end of the block w. If it does, a
+    # copy of a repeated eigenvalue (or any other) was 
+    # missed: the extreme eigenpairs of the projected M are
+    # merged in, the k extreme ones kept and the check 
+    # repeated, up to maxrestart times. After that, or if a
+    # residual is too large, matrices with up to densemax
+    # rows use the dense solver and larger ones are returned
+    # as they are, with a warning.
+    #
+    n=M.shape[0]
+    s=1.0 if (which == 'LA') else -1.0
+    c=abs(M).sum(axis=1).max()
+    tol=1e-8*max(c, 1.0)
+
+    # Largest eigenvalues of c*I + s*M (>= 0) in the 
+    # complement of v are its extreme ones in M
+    def complement(v, m):
+        def project(x):
+            return x - v.dot(v.T.dot(x))
+        def matvec(x):
+            x=project(np.ravel(x))
+            return project(c*x + s*M.dot(x))
+        op=LinearOperator((n, n), matvec=matvec, dtype=np.float64)
+        t, u = eigsh(op, k=m, which='LA')
+        return (t - c)/s, u
+
+    for restart in range(maxrestart+1):
+
+        res=np.sqrt(np.sum((M.dot(v) - v*w)**2, axis=0))
+        if (res > tol).any():
+            break
+
+        # End of the block: the eigenvalue of w closest to
+        # the interior of the spectrum
+        wend=(s*w).min()
+        t, u = complement(v, 1)
+        if (s*t[0] <= wend + tol):
+            order=np.argsort(w)
+            return w[order], v[:,order]
+        if (restart == maxrestart):
+            break
+
+        t, u = complement(v, min(k, n-k-1))
+        w=np.concatenate((w, t))
+        v=np.hstack((v, u))
+        best=np.argsort(-s*w, kind='mergesort')[:k]
+        w=w[best]
+        v=v[:,best]
+
+
+    if (n <= densemax):
+        return denseeigs(M, k, which)
+
+    print "WARNING: the sparse solver may have missed repeated eigenvalues of a ", n, "x", n, " matrix. Do not trust the end of the spectrum."
+    order=np.argsort(w)
+
+    return w[order], v[:,order]
+
+
+
+def deflated(M, k, value, known, s, c, v0=None):
+    #
+    # k extreme eigenvalues of the sparse symmetric M when
+    # the eigenvectors of one of them, value, are known (as
+    # returned by nullspace() or bipartite()). Those are
+    # returned with value, and the rest are the largest
+    # ones of c*I + s*M (s=1 for the largest of M, s=-1 for
+    # the smallest) with the known vectors projected out.
+    #
+    n=M.shape[0]
+    comp, z = known
+    inside=comp >= 0
+    nknown=comp.max()+1 if inside.any() else 0
+    Z=sparse.csr_matrix((z[inside], (np.flatnonzero(inside), comp[inside])), shape=(n, nknown))
+    if (nknown >= k):
+        order=np.argsort(np.bincount(comp[inside], minlength=nknown))[::-1][:k]
+        return np.repeat(value, k), Z[:,np.sort(order)].toarray()
+
+    def project(x):
+        return x - Z.dot(Z.T.dot(x))
+    def matvec(x):
+        x=project(np.ravel(x))
+        return project(c*x + s*M.dot(x))
+    op=LinearOperator((n, n), matvec=matvec, dtype=np.float64)
+    if v0 is not None:
+        v0=project(v0)
+        if not np.any(v0):
+            v0=None
+    w, v = eigsh(op, k=k-nknown, which='LA', v0=v0)
+    w=np.concatenate((np.repeat(value, nknown), (w - c)/s))
+    v=np.hstack((Z.toarray(), v))
+
+    return w, v
+
+
+
+class spectrum(object):
+    #
+    # Extreme eigenvalues of A or L_n for the networks of
+    # consecutive frames. The sparse solver of each frame
+    # starts from the eigenvectors of the previous one,
+    # which changes little between MD frames.
+    #
+    #   spec=spectra.spectrum(k=10, matrix='A', which='LA')
+    #   for ... frames ...:
+    #       w=spec(g)
+    #
+    #  - k: number of eigenvalues
+    #  - matrix: 'A' (adjacency) or 'L' (normalized
+    #            Laplacian)
+    #  - which: 'LA' largest or 'SA' smallest
+    #  - dense: see extremeeigs
+    #
+    def __init__(self, k=6, matrix='A', which='LA', dense=200):
+
+        if (matrix not in ('A', 'L')):
+            print "ERROR: matrix must be 'A' or 'L'. EXIT"
+            exit()
+
+        self.k=k
+        self.matrix=matrix
+        self.which=which
+        self.dense=dense
+
+        # Eigenvectors of the last frame
+        self.v=None
+
+
+
+    def __call__(self, g):
+        #
+        # Eigenvalues, in ascending order, for graph g
+        #
+        if (self.matrix == 'A'):
+            M=adjacency(g)
+        else:
+            M=laplacian(g)
+
+        null=None
+        top=None
+        if (self.matrix == 'L' and self.which == 'SA'):
+            null=nullspace(g)
+        if (self.matrix == 'L' and self.which == 'LA'):
+            top=bipartite(g)
+
+        v0=None
+        if (self.v is not None and len(self.v) == g.n):
+            v0=self.v.sum(axis=1)
+            if not np.any(v0):
+                v0=None
+
+        w, self.v = extremeeigs(M, self.k, self.which, v0=v0, dense=self.dense, null=null, top=top)
+
+        return w
@@ -0,0 +1,60 @@
+#
+# H-bond definitions of h2o.hbdefs on a frame of liquid
+# water: aliases give the same edges, distinct definitions
+# give different ones.
+#
+#   PYTHONPATH=pack python tests/test_hbdefs.py
+#
+import os
+import numpy as np
+import h2o
+
+
+ANIfile=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'H-b_network', 'water_1step.ANI')
+l=14.7222 # (Ang)
+
+
+
+def edgesets(names=None):
+    nat, comment, element, x = h2o.getframe(ANIfile, 0)
+    A=np.eye(3)*l
+    snap=h2o.snapshot(nat, A, x, element=element)
+    allmol=h2o.cluster.from_snapshot(snap, 3)
+    allmol.FindH2Os(snap.A, snap.Ainv, cutoff=3.0)
+
+    hbonds=h2o.find_hbonds_multi(allmol, names)
+    edges={}
+    for name in hbonds:
+        donor, acceptor = hbonds[name][:2]
+        edges[name]=set(zip(donor.tolist(), acceptor.tolist()))
+
+    return edges
+
+
+
+def test_alias():
+    edges=edgesets([1, 'luzar-chandler'])
+    assert edges['luzar-chandler'] == edges[1]
+
+    # aliases are left out when all definitions are asked
+    assert 'luzar-chandler' not in edgesets()
+
+
+
+def test_distinct():
+    edges=edgesets()
+    names=[1, 'rOH', 'combined']
+    for i in range(len(names)):
+        assert len(edges[names[i]]) > 0
+        for j in range(i+1, len(names)):
+            assert edges[names[i]] != edges[names[j]], (names[i], names[j])
+
+    # combined is both the angle and the rOH criterion
+    assert edges['combined'] == edges[1] & edges['rOH']
+
+
+
+if __name__ == '__main__':
+    test_alias()
+    test_distinct()
+    print "OK"
@@ -0,0 +1,64 @@
+#
+# Degrees and components of hbnet.hbnetwork, updated from
+# the edges formed and broken every frame, against those
+# of hbnet.stats for the whole network of the frame.
+#
+#   PYTHONPATH=pack python tests/test_hbnetwork.py
+#
+import numpy as np
+import hbnet
+
+
+
+def churn(n, m, maxvisit, nframes=40, seed=0):
+    #
+    # Random network of m edges with 10% of them replaced
+    # every frame
+    #
+    r=np.random.RandomState(seed)
+    net=hbnet.hbnetwork(n, maxvisit=maxvisit)
+    src=r.randint(0, n, m)
+    dst=r.randint(0, n, m)
+
+    for iframe in range(nframes):
+        new=r.rand(m) < 0.1
+        src[new]=r.randint(0, n, new.sum())
+        dst[new]=r.randint(0, n, new.sum())
+        net.update(src, dst)
+
+        S=hbnet.stats(hbnet.graph(n, src, dst))
+        assert S['ncomp'] == net.ncomp, iframe
+        assert (S['comp'] == net.comp).all(), iframe
+        assert (S['indeg'] == net.indeg).all()
+        assert (S['outdeg'] == net.outdeg).all()
+        assert (S['deg'] == net.deg).all()
+
+    return net
+
+
+
+def test_components():
+    churn(50, 40, 4096)
+    churn(300, 320, 4096, seed=1)
+
+
+
+def test_maxvisit():
+    # searches given up and components recomputed
+    churn(300, 320, 5, seed=2)
+
+
+
+def test_events():
+    net=churn(100, 80, 4096, nframes=10, seed=3)
+    ev=net.events()
+    assert ev[:,0].max() == 9
+    assert set(np.unique(ev[:,3])) <= set([-1, 1])
+
+
+
+if __name__ == '__main__':
+    test_components()
+    test_maxvisit()
+    test_events()
+    print "OK"
@@ -0,0 +1,112 @@
+#
+# Extreme eigenvalues of L_n and A against the dense 
+# eigensolver, for networks with several bipartite 
+# components (where the eigenvalue 2 of L_n is repeated),
+# several components (0 of L_n) and many identical ones
+# (repeated eigenvalues of A).
+#
+#   PYTHONPATH=pack python tests/test_spectra.py
+#
+import numpy as np
+import hbnet
+import spectra
+
+
+
+def network(seed=0):
+    #
+    # 100 disjoint 3-stars, some even rings and paths, a few
+    # isolated nodes and a random giant component with odd
+    # cycles
+    #
+    r=np.random.RandomState(seed)
+    src=[]
+    dst=[]
+    n=0
+
+    for i in range(100):
+        src+=[n, n, n]
+        dst+=[n+1, n+2, n+3]
+        n+=4
+    for m in (4, 6, 8):
+        src+=range(n, n+m)
+        dst+=range(n+1, n+m) + [n]
+        n+=m
+    for m in (2, 5):
+        src+=range(n, n+m-1)
+        dst+=range(n+1, n+m)
+        n+=m
+    n+=3
+
+    ngiant=300
+    src+=list(n + r.randint(0, ngiant, 3*ngiant))
+    dst+=list(n + r.randint(0, ngiant, 3*ngiant))
+    src+=range(n, n+ngiant-1)
+    dst+=range(n+1, n+ngiant)
+    n+=ngiant
+
+    src=np.array(src)
+    dst=np.array(dst)
+    keep= src != dst
+
+    return hbnet.graph(n, src[keep], dst[keep])
+
+
+
+def reference(g, k, which, matrix=spectra.laplacian):
+    w=np.linalg.eigh(matrix(g).toarray())[0]
+    if (which == 'LA'):
+        return w[len(w)-k:]
+    return w[:k]
+
+
+
+def test_laplacian_top():
+    g=network()
+    nbip=(spectra.bipartite(g)[0].max()+1)
+    assert nbip == 100 + 3 + 2
+
+    for k in (5, 8, nbip, nbip+6):
+        w=spectra.spectrum(k, matrix='L', which='LA')(g)
+        assert np.allclose(w, reference(g, k, 'LA'), atol=1e-8)
+
+
+
+def test_laplacian_bottom():
+    g=network(1)
+    for k in (8, 120):
+        w=spectra.spectrum(k, matrix='L', which='SA')(g)
+        assert np.allclose(w, reference(g, k, 'SA'), atol=1e-8)
+
+
+
+def test_adjacency():
+    g=network(0)
+    for which in ('LA', 'SA'):
+        for k in (10, 110):
+            w=spectra.spectrum(k, matrix='A', which=which)(g)
+            assert np.allclose(w, reference(g, k, which, spectra.adjacency), atol=1e-8)
+
+            # sparse solver only, without the dense fallback
+            w=spectra.extremeeigs(spectra.adjacency(g), k, which, densemax=0)[0]
+            assert np.allclose(w, reference(g, k, which, spectra.adjacency), atol=1e-8)
+
+
+
+def test_bipartite_vectors():
+    g=network(2)
+    L=spectra.laplacian(g)
+    comp, z = spectra.bipartite(g)
+    for c in range(comp.max()+1):
+        v=np.where(comp == c, z, 0.0)
+        assert np.allclose(L.dot(v), 2.0*v)
+        assert np.isclose(np.dot(v, v), 1.0)
+
+
+
+if __name__ == '__main__':
+    test_laplacian_top()
+    test_laplacian_bottom()
+    test_adjacency()
+    test_bipartite_vectors()
+    print "OK"
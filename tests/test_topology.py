@@ -0,0 +1,50 @@
+#
+# h2o.topology keeps its own element codes: swapping atoms
+# of a cluster it was built from (or applied to) must not
+# change the topology used for the next frames.
+#
+#   PYTHONPATH=pack python tests/test_topology.py
+#
+import os
+import numpy as np
+import h2o
+
+
+ANIfile=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'H-b_network', 'water_100steps.ANI')
+l=14.7222 # (Ang)
+
+
+
+def getcluster(iframe):
+    nat, comment, element, x = h2o.getframe(ANIfile, iframe)
+    A=np.eye(3)*l
+    snap=h2o.snapshot(nat, A, x, element=element)
+    return h2o.cluster.from_snapshot(snap, 3)
+
+
+
+def test_swap():
+    cl=getcluster(0)
+    topo=h2o.topology(cl, cutoff=3.0)
+    ecode=topo.ecode.copy()
+    Oindx=topo.Oindx.copy()
+
+    cl.swap(0, 1)
+    assert (topo.ecode == ecode).all()
+
+    cl2=getcluster(1)
+    topo.apply(cl2)
+    cl2.swap(0, 1)
+    assert (topo.ecode == ecode).all()
+
+    cl3=getcluster(2)
+    topo.update(cl3)
+    cl3.FindAtoms()
+    assert (cl3.Oindx == Oindx).all()
+    assert (cl3.ecode[cl3.Oindx] == 8).all()
+
+
+
+if __name__ == '__main__':
+    test_swap()
+    print "OK"